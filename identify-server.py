@@ -0,0 +1,73 @@
+#!/usr/bin/env python2.7
+
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Runs identification server with the model and database loaded once
+"""
+
+import sys
+import argparse
+import multiprocessing
+
+from nanoalign.server import serve
+from nanoalign.shards import tcp_address
+from nanoalign.model_loader import load_model
+from nanoalign.identifier import DISTANCES
+from nanoalign.precision import set_float32
+from nanoalign.__version__ import __version__
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nano-Align protein "
+                                     "identification server", formatter_class= \
+                                     argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("model_file", metavar="model_file",
+                        help="path to trained model file ('-' for MV model)")
+    parser.add_argument("database", metavar="database",
+                        help="database file (in FASTA format)")
+    parser.add_argument("address", metavar="address",
+                        help="UNIX socket path, or host:port with --http")
+    parser.add_argument("--http", action="store_true", default=False,
+                        dest="http", help="serve HTTP requests on host:port "
+                        "instead of the UNIX socket")
+    parser.add_argument("--data-dir", dest="data_dir", default=None,
+                        help="directory with nanospectra files that HTTP "
+                        "clients may request by name (by default, only "
+                        "inline blockades are accepted over HTTP)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--distance", dest="distance", choices=DISTANCES,
+                        default="rsquared", help="signal distance")
+    parser.add_argument("--both-orientations", action="store_true",
+                        default=False, dest="both_orientations",
+                        help="score proteins entering the pore from "
+                        "either end")
+    parser.add_argument("--grid-size", dest="grid_size", type=int,
+                        default=None, help="compare signals on a canonical "
+                        "grid (as of a protein of the given length)")
+    parser.add_argument("--float32", action="store_true", default=False,
+                        dest="float32", help="store traces and theoretical "
+                        "signals in single precision (halves the memory)")
+
+    parser.add_argument("--version", action="version", version=__version__)
+    args = parser.parse_args()
+    if args.http and tcp_address(args.address) is None:
+        parser.error("HTTP address should be host:port")
+    if args.data_dir and not args.http:
+        parser.error("--data-dir is only used with --http")
+
+    set_float32(args.float32)
+    model = load_model(args.model_file)
+    serve(model, args.database, args.address, args.workers, args.http,
+          args.data_dir, distance=args.distance, both_orientations=args.both_orientations,
+          grid_size=args.grid_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2.7
+
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Serves a shard of the database for the sharded identification
+"""
+
+import sys
+import argparse
+
+from nanoalign.shards import serve_shard, split_database
+from nanoalign.pvalues_test import _make_database
+from nanoalign.model_loader import load_model
+from nanoalign.identifier import DISTANCES
+from nanoalign.precision import set_float32
+from nanoalign.__version__ import __version__
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nano-Align database "
+                                     "shard server", formatter_class= \
+                                     argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("model_file", metavar="model_file",
+                        help="path to trained model file ('-' for MV model)")
+    parser.add_argument("database", metavar="database",
+                        help="database file (in FASTA format)")
+    parser.add_argument("address", metavar="address",
+                        help="UNIX socket path, or host:port for TCP")
+    parser.add_argument("--shard", dest="shard", type=int, default=0,
+                        help="index of the served shard (0-based)")
+    parser.add_argument("--num-shards", dest="num_shards", type=int,
+                        default=1, help="number of shards the database "
+                        "is split into")
+    parser.add_argument("--distance", dest="distance", choices=DISTANCES,
+                        default="rsquared", help="signal distance")
+    parser.add_argument("--both-orientations", action="store_true",
+                        default=False, dest="both_orientations",
+                        help="score proteins entering the pore from "
+                        "either end")
+    parser.add_argument("--grid-size", dest="grid_size", type=int,
+                        default=None, help="compare signals on a canonical "
+                        "grid (as of a protein of the given length)")
+    parser.add_argument("--float32", action="store_true", default=False,
+                        dest="float32", help="store theoretical signals "
+                        "in single precision (halves the memory)")
+
+    parser.add_argument("--version", action="version", version=__version__)
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.num_shards:
+        parser.error("shard index should be in [0, num_shards)")
+
+    set_float32(args.float32)
+    model = load_model(args.model_file)
+    database, _target = _make_database(args.database, None)
+    shard = split_database(database, args.num_shards)[args.shard]
+    serve_shard(model, shard, args.address, distance=args.distance,
+                both_orientations=args.both_orientations,
+                grid_size=args.grid_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
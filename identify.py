@@ -10,9 +10,15 @@ Runs identification test and report p-values
 
 import sys
 import argparse
+import multiprocessing
 
 from nanoalign.pvalues_test import pvalues_test
+from nanoalign.batch import batch_identify
+from nanoalign.identifier import DISTANCES
+from nanoalign.results import ResultsWriter
+from nanoalign.profiling import run_profiled
 from nanoalign.model_loader import load_model
+from nanoalign.precision import set_float32
 from nanoalign.__version__ import __version__
 
 
@@ -22,7 +28,8 @@ def main():
                                      argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("nanospectra_file", metavar="nanospectra_file",
-                        help="path to nanospectra file (in mat format)")
+                        help="path to nanospectra file (in mat format) or "
+                        "comma-separated list of files")
     parser.add_argument("model_file", metavar="model_file",
                         help="path to trained model file ('-' for MV model)")
     parser.add_argument("-c", "--cluster-size", dest="cluster_size", type=int,
@@ -31,16 +38,104 @@ def main():
                         metavar="database", help="database file (in FASTA "
                         "format). If not set, random database is generated",
                         default=None)
+    parser.add_argument("--shards", dest="shards", metavar="addresses",
+                        default=None, help="comma-separated addresses of "
+                        "the shard servers (see identify-shard.py), which "
+                        "are searched instead of the database file")
     parser.add_argument("-s", "--single-nanospectra", action="store_true",
                         default=False, dest="single_nanospectra",
                         help="print statistics for each nanospectra in a cluster")
+    parser.add_argument("--distance", dest="distance", choices=DISTANCES,
+                        default="rsquared", help="signal distance: 1 - R^2, "
+                        "banded DTW (tolerates translocation speed "
+                        "variation) or 1 - max shifted cross-correlation")
+    parser.add_argument("--both-orientations", action="store_true",
+                        default=False, dest="both_orientations",
+                        help="score proteins entering the pore from "
+                        "either end")
+
+    parser.add_argument("--grid-size", dest="grid_size", type=int,
+                        default=None, help="compare signals on a canonical "
+                        "grid (as of a protein of the given length), so "
+                        "the whole database is scored as a single matrix "
+                        "(approximate)")
+    parser.add_argument("--float32", action="store_true", default=False,
+                        dest="float32", help="store traces and theoretical "
+                        "signals in single precision (halves the memory)")
+
+    parser.add_argument("-m", "--manifest", dest="manifest", default=None,
+                        help="file with a list of nanospectra files "
+                        "(one per line), identified in addition to "
+                        "nanospectra_file ('-' to identify only these)")
+    parser.add_argument("-t", "--threads", dest="threads", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of parallel processes for "
+                        "multiple files")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="write per-cluster results to a file (JSON "
+                        "lines if ends with .jsonl, TSV otherwise; '-' for "
+                        "stdout). Multiple files are written to stdout "
+                        "by default")
+    parser.add_argument("--top", dest="top", type=int, default=5,
+                        help="number of best database proteins reported "
+                        "for each cluster")
+    parser.add_argument("--distance-matrix", dest="distance_matrix",
+                        metavar="npz_file", default=None, help="store "
+                        "distances from each cluster to all database "
+                        "proteins (float32 NPZ)")
+    parser.add_argument("--profile", dest="profile", metavar="report_file",
+                        default=None, help="write per-stage timings "
+                        "(JSON if ends with .json, TSV otherwise)")
+    parser.add_argument("--cprofile", dest="cprofile", metavar="stats_file",
+                        default=None, help="run under cProfile and dump "
+                        "the stats file")
 
     parser.add_argument("--version", action="version", version=__version__)
     args = parser.parse_args()
+    shards = args.shards.split(",") if args.shards else None
+    if shards and (args.single_nanospectra or args.distance_matrix):
+        parser.error("--single-nanospectra and --distance-matrix "
+                     "are not supported with --shards")
+
+    set_float32(args.float32)
+    nanospectra_files = []
+    if args.nanospectra_file != "-":
+        nanospectra_files.extend(args.nanospectra_file.split(","))
+    if args.manifest:
+        with open(args.manifest) as f:
+            nanospectra_files.extend(filter(None, map(str.strip, f)))
+
+    def identify():
+        model = load_model(args.model_file)
+        output = args.output
+        if output is None and len(nanospectra_files) > 1:
+            output = "-"
+        results = ResultsWriter(output, args.distance_matrix, args.top)
+        try:
+            if len(nanospectra_files) == 1:
+                pvalues_test(nanospectra_files[0], args.cluster_size, model,
+                             args.database, args.single_nanospectra,
+                             sys.stderr, args.distance,
+                             args.both_orientations, results, shards,
+                             args.grid_size)
+                return
+            median_pvalues = batch_identify(nanospectra_files,
+                                            args.cluster_size, model,
+                                            args.database, args.threads,
+                                            results, shards,
+                                            distance=args.distance,
+                                            both_orientations=
+                                                args.both_orientations,
+                                            grid_size=args.grid_size)
+        finally:
+            results.close()
 
-    model = load_model(args.model_file)
-    pvalues_test(args.nanospectra_file, args.cluster_size, model,
-                 args.database, args.single_nanospectra, sys.stderr)
+        sys.stderr.write("\nFile\tMedian_pval\n")
+        for filename in nanospectra_files:
+            p_value = median_pvalues.get(filename)
+            sys.stderr.write("{0}\t{1}\n".format(filename, "NA"
+                             if p_value is None else p_value))
+    run_profiled(identify, args.profile, args.cprofile)
     return 0
 
 
@@ -0,0 +1,124 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Database index (theoretical signals by length buckets and protein ids)
+in shared memory, attached read-only by the worker processes
+"""
+
+import os
+import json
+import atexit
+import shutil
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import nanoalign.profiling as prof
+
+
+SHM_DIR = "/dev/shm"
+
+
+class SignalArena(object):
+    """
+    A directory (in /dev/shm if available) with .npy files for the
+    signal matrix and protein ids of each length bucket. Attached
+    signals are read-only memory maps, so all processes share the same
+    physical pages instead of holding a copy each. The directory is
+    removed by the creating process on close() or at exit
+    """
+    def __init__(self, path, owner=False):
+        self.path = path
+        self.owner = owner
+
+    @classmethod
+    def create(cls, db_signals, directory=None):
+        """
+        Stores the database index ({length: (protein ids, signals)},
+        as built by Identifier) in a new arena
+        """
+        arena = cls._new(directory)
+        try:
+            arena._write(db_signals)
+        except:
+            arena.close()
+            raise
+        return arena
+
+    @classmethod
+    def build(cls, identifier, directory=None):
+        """
+        Builds the database index of the identifier in a child process
+        and stores it in a new arena. This way, the intermediate signals
+        never occupy (and fragment) the heap of the calling process,
+        which would otherwise be inherited by the forked workers.
+        Profiling stats of the child are merged into the caller's
+        """
+        arena = cls._new(directory)
+        receiver, sender = multiprocessing.Pipe(False)
+        builder = multiprocessing.Process(target=_build_index,
+                                          args=(identifier, arena, sender))
+        builder.start()
+        sender.close()
+        try:
+            prof.merge(receiver.recv())
+        except EOFError:
+            pass
+        receiver.close()
+        builder.join()
+        if builder.exitcode != 0:
+            arena.close()
+            raise RuntimeError("Failed to build the database index")
+        return arena
+
+    @classmethod
+    def _new(cls, directory):
+        if directory is None:
+            directory = SHM_DIR if os.path.isdir(SHM_DIR) else None
+        arena = cls(tempfile.mkdtemp(prefix="nanoalign-arena-",
+                                     dir=directory), owner=True)
+        atexit.register(arena.close)
+        return arena
+
+    def _write(self, db_signals):
+        for length, (prot_ids, signals) in db_signals.items():
+            np.save(self._file("ids", length), np.array(prot_ids))
+            np.save(self._file("signals", length), signals)
+        with open(os.path.join(self.path, "lengths.json"), "w") as f:
+            json.dump(db_signals.keys(), f)
+
+    def signals(self):
+        """
+        Returns the database index with memory-mapped signal matrices
+        """
+        with open(os.path.join(self.path, "lengths.json")) as f:
+            lengths = json.load(f)
+
+        db_signals = OrderedDict()
+        for length in lengths:
+            prot_ids = map(str, np.load(self._file("ids", length)))
+            db_signals[length] = (prot_ids,
+                                  np.load(self._file("signals", length),
+                                          mmap_mode="r"))
+        return db_signals
+
+    def close(self):
+        if self.owner:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def _file(self, name, length):
+        return os.path.join(self.path, "{0}_{1}.npy".format(name, length))
+
+
+def _build_index(identifier, arena, sender):
+    #the child process must not remove the arena at its exit
+    arena.owner = False
+    prof.reset()
+    with prof.stage("build_arena"):
+        arena._write(identifier._database_signals())
+    sender.send(prof.snapshot())
+    sender.close()
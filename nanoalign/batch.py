@@ -0,0 +1,129 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Identification of multiple nanospectra files with a shared database
+"""
+
+import random
+import multiprocessing
+
+import numpy as np
+
+from nanoalign.identifier import Identifier
+from nanoalign.arena import SignalArena
+from nanoalign.shards import ShardedIdentifier
+from nanoalign.blockade import iter_blockades, peek_peptide
+from nanoalign.pvalues_test import _make_database, identify_clusters
+import nanoalign.signal_proc as sp
+import nanoalign.profiling as prof
+
+
+#set before the worker pool is forked; the database index built
+#in the parent process is attached by the workers from a shared arena
+_identifier = None
+_targets = None
+_settings = None
+
+
+def _init_worker(arena_path=None):
+    random.seed()
+    #timings inherited from the parent are reported by the parent
+    prof.reset()
+    if arena_path is not None:
+        _identifier.set_database_signals(SignalArena(arena_path).signals())
+
+
+def _identify_file(filename):
+    """
+    Identifies clusters of a single file, returns cluster results
+    and (if the distance matrix is requested) float32 distances
+    to all database proteins, and the worker's profiling stats
+    for this file
+    """
+    RANDOM_DB_SIZE = 10000
+    (cluster_size, blockade_model, top, with_matrix, shards,
+     identifier_args) = _settings
+
+    true_peptide, chunks = peek_peptide(iter_blockades(filename))
+    if shards is not None:
+        identifier = ShardedIdentifier(blockade_model, shards,
+                                       **identifier_args)
+    elif _identifier is None:
+        identifier = Identifier(blockade_model, **identifier_args)
+        identifier.random_database(true_peptide, RANDOM_DB_SIZE)
+        target_id = "target"
+    else:
+        identifier = _identifier
+        target_id = _targets.get(true_peptide)
+
+    clusters = sp.iter_clusters(chunks, cluster_size=cluster_size,
+                                min_dwell=0.5, max_dwell=20)
+    rows = []
+    if shards is not None:
+        identified = identifier.identify_clusters(clusters, true_peptide, top)
+    else:
+        identified = identify_clusters(identifier, clusters, target_id, top)
+    for num, (cluster, distances, result) in enumerate(identified):
+        result.update({"file": filename, "cluster": num + 1,
+                       "size": len(cluster.indices)})
+        rows.append((result, distances.astype(np.float32)
+                             if with_matrix else None))
+    if shards is not None:
+        identifier.close()
+    stats = prof.snapshot()
+    prof.reset()
+    return rows, stats
+
+
+def batch_identify(nanospectra_files, cluster_size, blockade_model, db_file,
+                   num_proc, results, shards=None, **identifier_args):
+    """
+    Identifies clusters of each of the files in parallel and passes
+    the cluster results to the results writer. With a database
+    file, the database and its theoretical signals are prepared once
+    and shared by the workers through a SignalArena. With shard
+    addresses, the database is searched on the shard servers.
+    Returns the median p-value for each file
+    """
+    global _identifier, _targets, _settings
+    arena = None
+    with_matrix = results.matrix_file is not None
+    if with_matrix and (db_file is None or shards is not None):
+        raise ValueError("Distance matrix requires a database file")
+    if with_matrix:
+        identifier_args = dict(identifier_args, dtw_prune=False)
+    _settings = (cluster_size, blockade_model, results.top, with_matrix,
+                 shards, identifier_args)
+    if db_file is not None and shards is None:
+        database, _target = _make_database(db_file, None)
+        _identifier = Identifier(blockade_model, **identifier_args)
+        _identifier.set_database(database)
+        arena = SignalArena.build(_identifier)
+        _identifier.set_database_signals(arena.signals())
+        _targets = dict((seq, prot_id) for prot_id, seq in database.items())
+
+    pool = multiprocessing.Pool(num_proc, _init_worker,
+                                (arena and arena.path,))
+    median_pvalues = {}
+    try:
+        for filename, (rows, stats) in zip(nanospectra_files,
+                                           pool.imap(_identify_file,
+                                                     nanospectra_files)):
+            prof.merge(stats)
+            for result, distances in rows:
+                results.write(result, distances, _identifier and
+                                                 _identifier.db_protein_ids())
+            p_values = filter(lambda p: p is not None,
+                              map(lambda r: r[0]["p_value"], rows))
+            median_pvalues[filename] = (np.median(p_values)
+                                        if p_values else None)
+        pool.close()
+    finally:
+        pool.terminate()
+        if arena is not None:
+            arena.close()
+        _identifier = _targets = _settings = None
+
+    return median_pvalues
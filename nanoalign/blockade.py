@@ -6,9 +6,14 @@
 This module defines blockade structure and IO functions
 """
 
+from itertools import chain
+
 import scipy.io as sio
 import numpy as np
 
+import nanoalign.profiling as prof
+from nanoalign.precision import float_type
+
 
 class Blockade(object):
     """
@@ -27,11 +32,18 @@ class Blockade(object):
 
 
 class BlockadeCluster(object):
-    def __init__(self, consensus, blockades):
+    """
+    Consensus signal of the clustered blockades. Indices are the
+    positions of the blockades in the input; the blockades themselves
+    could be omitted (None) to save memory
+    """
+    def __init__(self, consensus, blockades, indices=None):
         self.consensus = consensus
         self.blockades = blockades
+        self.indices = indices
 
 
+@prof.timed("read_mat")
 def read_mat(filename):
     """
     Load blockades from mat file
@@ -54,12 +66,13 @@ def read_mat(filename):
         except IndexError:
             peptide = None
 
-        trace = np.array(event_traces[:, sample_id])
+        trace = np.array(event_traces[:, sample_id], dtype=float_type())
 
         out_struct = Blockade(file_tag, start_point, dwell, pa_blockade,
                               open_pore, trace, correlation, peptide)
         blockades.append(out_struct)
 
+    prof.count("blockades_read", len(blockades))
     return blockades
 
 
@@ -83,3 +96,103 @@ def write_mat(blockades, filename):
               np.transpose(event_trace_arr), [open_pore_arr],
               [corr_arr], peptide_arr)
     sio.savemat(filename, {"Struct" : np.array([[struct]], dtype=dtype)})
+
+
+def read_blockades(filename):
+    """
+    Load blockades from mat file or from the native (.npy) file
+    """
+    if filename.endswith(".npy"):
+        return read_npy(filename)
+    return read_mat(filename)
+
+
+def iter_blockades(filename, chunk_size=256):
+    """
+    Yields blockades in chunks (lists) of chunk_size. Native files are
+    read chunk by chunk, so only the current chunk is kept in memory.
+    Mat files can not be read partially and are yielded as a single chunk
+    """
+    if not filename.endswith(".npy"):
+        yield read_mat(filename)
+        return
+
+    with open(filename, "rb") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, _fortran, dtype = header
+        for chunk_start in xrange(0, shape[0], chunk_size):
+            with prof.stage("read_npy"):
+                records = np.fromfile(f, dtype=dtype,
+                                      count=min(chunk_size,
+                                                shape[0] - chunk_start))
+                chunk = map(_record_blockade, records)
+            prof.count("blockades_read", len(chunk))
+            yield chunk
+
+
+def peek_peptide(blockade_chunks):
+    """
+    Returns the peptide of the first blockade together with
+    the chunks iterator (with the first chunk put back)
+    """
+    blockade_chunks = iter(blockade_chunks)
+    first_chunk = next(blockade_chunks, [])
+    peptide = first_chunk[0].peptide if first_chunk else None
+    return peptide, chain([first_chunk], blockade_chunks)
+
+
+@prof.timed("read_npy")
+def read_npy(filename):
+    """
+    Load blockades from the native format
+    """
+    records = np.load(filename, mmap_mode="r")
+    blockades = map(_record_blockade, records)
+    prof.count("blockades_read", len(blockades))
+    return blockades
+
+
+def _record_blockade(record):
+    peptide = str(record["peptide"]) or None
+    return Blockade(str(record["fileTag"]), float(record["StartPoint"]),
+                    float(record["ms_Dwell"]), float(record["pA_Blockade"]),
+                    float(record["openPore"]),
+                    np.array(record["eventTrace"], dtype=float_type()),
+                    float(record["correlation"]), peptide)
+
+
+def write_npy(blockades, filename, num_blockades=None, trace_dtype="f8"):
+    """
+    Store blockades in the native format: a numpy array with a record
+    per blockade, which is memory-mapped on reading. All blockades should
+    have traces of the same length and come from the same protein (as in
+    mat files). If num_blockades is given, blockades could be an iterator:
+    they are written one by one without being kept in memory
+    """
+    if num_blockades is None:
+        blockades = list(blockades)
+        num_blockades = len(blockades)
+
+    records = None
+    for num, blockade in enumerate(blockades):
+        file_tag = str(blockade.fileTag)
+        peptide = blockade.peptide or ""
+        if records is None:
+            dtype = [("fileTag", "S{0}".format(max(1, len(file_tag)))),
+                     ("StartPoint", "f8"), ("ms_Dwell", "f8"),
+                     ("pA_Blockade", "f8"), ("openPore", "f8"),
+                     ("correlation", "f8"),
+                     ("peptide", "S{0}".format(max(1, len(peptide)))),
+                     ("eventTrace", trace_dtype, (len(blockade.eventTrace),))]
+            records = np.lib.format.open_memmap(filename, mode="w+",
+                                                dtype=dtype,
+                                                shape=(num_blockades,))
+        records[num] = (file_tag, blockade.StartPoint, blockade.ms_Dwell,
+                        blockade.pA_Blockade, blockade.openPore,
+                        blockade.correlation, peptide, blockade.eventTrace)
+
+    if records is not None:
+        records.flush()
@@ -6,6 +6,8 @@
 Abstract blockade model
 """
 
+import numpy as np
+
 class ModelDump(object):
     def __init__(self, name, predictor):
         self.name = name
@@ -50,6 +52,30 @@ class BlockadeModel(object):
     def peptide_signal(self, peptide):
         pass
 
+    def _training_matrix(self, peptides, signals):
+        """
+        Builds the training feature matrix and the vector of signal
+        values. Features are computed once per unique peptide and copied
+        into the preallocated matrix
+        """
+        features = {}
+        for peptide in set(peptides):
+            features[peptide] = np.array(self._peptide_to_features(peptide),
+                                         dtype=float)
+
+        num_rows = sum(map(len, signals))
+        num_features = features[peptides[0]].shape[1]
+        train_features = np.empty((num_rows, num_features))
+        train_signals = np.empty(num_rows)
+        row = 0
+        for peptide, signal in zip(peptides, signals):
+            assert len(features[peptide]) == len(signal)
+            train_features[row : row + len(signal)] = features[peptide]
+            train_signals[row : row + len(signal)] = signal
+            row += len(signal)
+
+        return train_features, train_signals
+
     def load_from_dump(self, dump):
         if self.name == dump.name:
             self.predictor = dump.predictor
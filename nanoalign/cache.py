@@ -0,0 +1,191 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+On-disk cache of preprocessed and discretized signals, keyed by
+the blockades file content and the preprocessing parameters
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+from nanoalign.blockade import BlockadeCluster, iter_blockades, peek_peptide
+from nanoalign.precision import float_type, as_float
+from nanoalign.__version__ import __version__
+import nanoalign.signal_proc as sp
+
+
+#part of the cache key, increase when preprocessing or discretization
+#changes, so the entries computed by the previous code are not reused
+CACHE_VERSION = 2
+
+
+class PreprocessedSignals(object):
+    """
+    Clusters of a blockades file as arrays: member indices
+    (clusters x cluster size), consensus signals concatenated into
+    a single array with offsets (consensus lengths differ after flank
+    trimming) and the discretized consensus (clusters x peaks)
+    """
+    def __init__(self, peptide, indices, consensus, offsets, discrete):
+        self.peptide = peptide
+        self.indices = indices
+        self.consensus = consensus
+        self.offsets = offsets
+        self.discrete = discrete
+
+    def clusters(self):
+        """
+        Returns the clusters (with consensus views, without blockades)
+        """
+        return map(lambda i: BlockadeCluster(self.consensus[self.offsets[i] :
+                                                            self.offsets[i + 1]],
+                                             None, self.indices[i].tolist()),
+                   xrange(len(self.indices)))
+
+
+class SignalCache(object):
+    """
+    Cache entries are directories with .npy files, which are memory-mapped
+    on reading. Least recently used entries are removed when the total
+    size exceeds max_size (in bytes)
+    """
+    FILES = ["indices", "consensus", "offsets", "discrete"]
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hashes = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        """
+        Returns the entry or None. An entry removed by a concurrent
+        eviction while being read is a cache miss (and what is left
+        of it is removed, so it could be stored again)
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        try:
+            os.utime(entry_dir, None)
+            with open(os.path.join(entry_dir, "meta.json")) as f:
+                peptide = json.load(f)["peptide"]
+            arrays = map(lambda name: np.load(os.path.join(entry_dir,
+                                                           name + ".npy"),
+                                              mmap_mode="r"), self.FILES)
+        except (IOError, OSError, ValueError):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        peptide = str(peptide) if peptide is not None else None
+        return PreprocessedSignals(peptide, *arrays)
+
+    def put(self, key, signals, meta):
+        """
+        Stores the entry (written to a temporary directory first,
+        so readers never see a partial entry) and evicts old ones
+        """
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp")
+        try:
+            for name in self.FILES:
+                np.save(os.path.join(temp_dir, name + ".npy"),
+                        getattr(signals, name))
+            with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+                json.dump(dict(meta, peptide=signals.peptide), f)
+            os.rename(temp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            #the same entry has been stored concurrently
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self._evict()
+
+    def file_hash(self, filename):
+        """
+        SHA1 of the file content, memoized by path, size and mtime
+        """
+        stat = os.stat(filename)
+        file_id = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if file_id not in self.hashes:
+            self.hashes[file_id] = file_sha1(filename)
+        return self.hashes[file_id]
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(map(lambda f: os.path.getsize(
+                                            os.path.join(entry_dir, f)),
+                               os.listdir(entry_dir)))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except OSError:
+                #evicted concurrently
+                continue
+
+        total_size = sum(map(lambda e: e[1], entries))
+        for _mtime, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+
+def file_sha1(filename):
+    """
+    SHA1 of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def preprocessed_signals(filename, cluster_size=1, min_dwell=0.5,
+                         max_dwell=20, seed=None, protein_length=None,
+                         cache=None):
+    """
+    Preprocesses blockades of the file and discretizes the cluster
+    consensus assuming the given protein length (by default, length of
+    the file's protein). Results are taken from / stored in the cache
+    (SignalCache) if it is given and the clustering is deterministic:
+    cluster_size is 1 or the seed is given
+    """
+    params = {"cluster_size": cluster_size, "min_dwell": min_dwell,
+              "max_dwell": max_dwell, "seed": seed,
+              "protein_length": protein_length,
+              "dtype": np.dtype(float_type()).name,
+              "version": [__version__, CACHE_VERSION]}
+    key = None
+    if cache is not None and (cluster_size == 1 or seed is not None):
+        key = hashlib.sha1(cache.file_hash(filename) +
+                           json.dumps(params, sort_keys=True)).hexdigest()
+        signals = cache.get(key)
+        if signals is not None:
+            return signals
+
+    peptide, chunks = peek_peptide(iter_blockades(filename))
+    length = protein_length or len(peptide)
+    clusters = list(sp.iter_clusters(chunks, cluster_size, min_dwell,
+                                     max_dwell, seed=seed))
+    consensus = map(lambda c: as_float(c.consensus), clusters)
+    indices = np.array(map(lambda c: c.indices, clusters), dtype=np.int64)
+    signals = PreprocessedSignals(peptide,
+                                  indices.reshape(len(clusters), cluster_size),
+                                  np.concatenate([as_float([])] + consensus),
+                                  np.cumsum([0] + map(len, consensus)),
+                                  as_float(map(lambda c: sp.discretize(c,
+                                                                       length),
+                                               consensus)))
+    if key is not None:
+        cache.put(key, signals, {"file": os.path.abspath(filename),
+                                 "params": params})
+    return signals
@@ -7,22 +7,78 @@ Protein identification module
 """
 
 import random
-from itertools import izip
-import matplotlib.pyplot as plt
-import matplotlib
+from collections import defaultdict, OrderedDict
 import numpy as np
-from scipy.spatial import distance
 
 import nanoalign.signal_proc as sp
+import nanoalign.profiling as prof
+from nanoalign.precision import as_float
+
+DISTANCES = ["rsquared", "dtw", "xcorr"]
+
+
+class ScoringContext(object):
+    """
+    Discretized signal(s) together with the statistics that
+    all distance functions reuse for every database protein
+    """
+    def __init__(self, signals):
+        self.signals = np.atleast_2d(as_float(signals))
+        self.mean = np.mean(self.signals, axis=1)
+        self.centered = self.signals - self.mean[:, np.newaxis]
+        self.variance = np.sum(self.centered ** 2, axis=1)
+        self.sq_norm = np.sum(self.signals ** 2, axis=1)
+
 
 class Identifier(object):
-    def __init__(self, blockade_model):
+    def __init__(self, blockade_model, distance="rsquared", dtw_band=0.1,
+                 xcorr_lag=0.1, both_orientations=False, grid_size=None,
+                 dtw_prune=True):
+        """
+        If grid_size is set, theoretical signals of all proteins are
+        resampled onto a canonical grid (as of a protein of grid_size
+        length), and the consensus is discretized once onto the same grid.
+        If dtw_prune is unset, DTW distances to all proteins are computed
+        exactly (see score_db_proteins)
+        """
+        assert distance in DISTANCES
         self.blockade_model = blockade_model
+        self.distance = distance
+        self.dtw_band = dtw_band
+        self.xcorr_lag = xcorr_lag
+        self.both_orientations = both_orientations
+        self.grid_size = grid_size
+        self.dtw_prune = dtw_prune
         self.database = None
+        self.db_signals = None
+        self.db_ids = None
 
     def signal_protein_distance(self, signal, peptide):
-        theor_signal = self.blockade_model.peptide_signal(peptide)
-        return _signals_distance(signal, theor_signal)
+        return self.signals_peptides_distances([signal], [peptide])[0, 0]
+
+    def signals_peptides_distances(self, signals, peptides):
+        """
+        Computes the matrix of distances between discretized signals
+        and peptides (all of the same length) in a single batch
+        """
+        theor_signals = map(self.blockade_model.peptide_signal, peptides)
+        return self._distance_matrix(ScoringContext(signals),
+                                     as_float(theor_signals))
+
+    def protein_distance(self, signal, sequence):
+        """
+        Distance between the signal and a protein (not necessarily
+        from the database) computed as for the database proteins
+        """
+        sequences = [sequence]
+        if self.both_orientations:
+            sequences.append(sequence[::-1])
+        length = self.grid_size or len(sequence)
+        context = ScoringContext(sp.discretize(signal, length))
+        theor_signals = map(lambda s: self._theoretical_signal(s, length),
+                            sequences)
+        return float(np.min(self._distance_matrix(context,
+                                                  as_float(theor_signals))))
 
     def set_database(self, database):
         """
@@ -30,6 +86,8 @@ class Identifier(object):
         database is generated
         """
         self.database = database
+        self.db_signals = None
+        self.db_ids = None
 
     def random_database(self, protein, size):
         """
@@ -46,38 +104,318 @@ class Identifier(object):
             database[decoy_name] = "".join(weights_list)
 
         self.database = database
+        self.db_signals = None
+        self.db_ids = None
+
+    def set_database_signals(self, db_signals):
+        """
+        Uses the given theoretical signals of the database proteins
+        ({length: (protein ids, matrix of signals)}, e.g. attached
+        from a SignalArena) instead of building them
+        """
+        self.db_signals = db_signals
+        self.db_ids = sum(map(lambda b: b[0], db_signals.values()), [])
 
     def identify(self, signal):
         """
         Returns the most similar protein from the database
         """
-        return self.rank_database(signal)[0]
+        return self.rank_db_proteins(signal)[0]
 
-    def rank_db_proteins(self, signal):
+    @prof.timed("rank_db_proteins")
+    def rank_db_proteins(self, signal, target_id=None):
         """
         Rank database proteins wrt to the similarity to a given signal
         """
+        distances = self.score_db_proteins(signal, target_id)
+        order = np.argsort(distances, kind="mergesort")
+        return [(self.db_ids[i], distances[i]) for i in order]
+
+    def db_protein_ids(self):
+        """
+        Database protein ids in the order of score_db_proteins output
+        """
+        self._database_signals()
+        return self.db_ids
+
+    @prof.timed("score_db_proteins")
+    def score_db_proteins(self, signal, target_id=None, target_dist=None):
+        """
+        Computes distances between the signal and all database proteins.
+        Returns an array in the order of db_protein_ids(). Proteins that
+        are too long for the signal to be discretized get infinite distance.
+        With DTW pruning, only the closest proteins are scored exactly,
+        and the pruned ones get infinite distance. The target protein
+        and all proteins closer than it (or than target_dist) are always
+        scored exactly, so its rank is exact
+        """
         assert self.database is not None
 
-        distances = {}
-        discretized = {}
+        contexts = {}
+        for length in self._database_signals():
+            with prof.stage("discretize"):
+                contexts[length] = ScoringContext(sp.discretize(signal,
+                                                                length))
+        prof.count("scored_proteins", len(self.database))
 
+        if self.distance == "dtw":
+            return self._dtw_distances(contexts, target_id, target_dist)
+
+        distances = []
+        for length, (prot_ids, signals) in self.db_signals.items():
+            bucket_dist = self._distance_matrix(contexts[length], signals)
+            distances.append(self._best_orientation(bucket_dist[0]))
+        distances = np.concatenate(distances)
+        distances[np.isnan(distances)] = np.inf
+        return distances
+
+    def _database_signals(self):
+        """
+        Groups theoretical signals of the database proteins by length:
+        {length: (protein ids, matrix of signals)}, ordered by length.
+        If both orientations
+        are considered, signals of the reversed proteins follow
+        the forward ones in the same matrix
+        """
+        if self.db_signals is None:
+            self.set_database_signals(self._build_database_signals())
+        return self.db_signals
+
+    @prof.timed("theoretical_signals")
+    def _build_database_signals(self):
+        by_length = defaultdict(list)
         for prot_id, prot_seq in self.database.items():
-            if len(prot_seq) not in discretized:
-                discretized[len(prot_seq)] = sp.discretize(signal, len(prot_seq))
+            by_length[len(prot_seq)].append(prot_id)
+
+        if self.grid_size:
+            #a single bucket with all proteins
+            by_length = {self.grid_size: sum(map(lambda b: b[1],
+                                                 sorted(by_length.items())),
+                                             [])}
 
-            distance = self.signal_protein_distance(discretized[len(prot_seq)],
-                                                    prot_seq)
-            distances[prot_id] = distance
+        db_signals = OrderedDict()
+        for length, prot_ids in sorted(by_length.items()):
+            sequences = map(self.database.get, prot_ids)
+            if self.both_orientations:
+                sequences += map(lambda s: s[::-1], sequences)
+            signals = map(lambda s: self._theoretical_signal(s, length),
+                          sequences)
+            db_signals[length] = (prot_ids, as_float(signals))
+        return db_signals
 
-        return sorted(distances.items(), key=lambda i: i[1])
+    def _theoretical_signal(self, sequence, length):
+        """
+        Theoretical signal of the protein, linearly resampled
+        to the number of peaks of the given protein length
+        (for the canonical grid)
+        """
+        signal = self.blockade_model.peptide_signal(sequence)
+        num_peaks = length + len(signal) - len(sequence)
+        if num_peaks == len(signal):
+            return signal
+        return np.interp(np.linspace(0, 1, num_peaks),
+                         np.linspace(0, 1, len(signal)), signal)
 
+    def _best_orientation(self, distances):
+        """
+        Chooses the best of the forward and reverse distances
+        for each protein of a length bucket
+        """
+        if not self.both_orientations:
+            return distances
+        num_proteins = len(distances) / 2
+        return np.minimum(distances[:num_proteins], distances[num_proteins:])
 
-def _signals_distance(real_signal, model_signal):
+    def _distance_matrix(self, context, candidates):
+        """
+        Computes distances between each of the context signals
+        and each of the candidate signals (matrix rows) of the same length
+        """
+        if self.distance == "rsquared":
+            return _rsquared_distances(context, candidates)
+
+        length = context.signals.shape[1]
+        if self.distance == "xcorr":
+            max_lag = max(1, int(self.xcorr_lag * length))
+            return 1 - _max_cross_correlation(context, candidates, max_lag)
+
+        band = max(1, int(self.dtw_band * length))
+        distances = np.empty((len(context.signals), len(candidates)))
+        for row, query in enumerate(context.signals):
+            distances[row] = (_dtw_distances(query, candidates, band) /
+                              context.variance[row])
+        return distances
+
+    def _dtw_distances(self, contexts, target_id, target_dist):
+        """
+        Computes banded DTW distances to the database proteins.
+        Proteins are processed in the order of their LB_Keogh lower bounds
+        until the bound exceeds both the distance of the DTW_EXACT-th best
+        protein and the target distance. The bounds never exceed the true
+        DTW distances, so the rest are farther and get infinite distance
+        """
+        DTW_EXACT = 100
+        DTW_BATCH = 64
+
+        lengths = []
+        rows = []
+        lower_bounds = []
+        for length, (bucket_ids, signals) in self.db_signals.items():
+            context = contexts[length]
+            band = max(1, int(self.dtw_band * length))
+            lengths.extend([length] * len(signals))
+            rows.extend(xrange(len(signals)))
+            lower_bounds.append(_lb_keogh(context.signals[0], signals, band) /
+                                context.variance[0])
+
+        lengths = np.array(lengths)
+        rows = np.array(rows)
+        bounds = np.concatenate(lower_bounds)
+        bounds[np.isnan(bounds)] = np.inf
+        distances = np.full(len(bounds), np.inf)
+        scored = np.zeros(len(bounds), dtype=bool)
+
+        def score(batch):
+            for length in np.unique(lengths[batch]):
+                in_bucket = batch[lengths[batch] == length]
+                signals = self.db_signals[length][1][rows[in_bucket]]
+                distances[in_bucket] = \
+                        self._distance_matrix(contexts[length], signals)[0]
+            bounds[batch] = distances[batch]
+            scored[batch] = True
+
+        min_threshold = -np.inf
+        if target_id in self.db_ids:
+            target_rows = self._protein_rows(target_id)
+            score(target_rows)
+            min_threshold = np.min(distances[target_rows])
+        elif target_dist is not None:
+            min_threshold = target_dist
+
+        order = np.argsort(bounds)
+        exact = []
+        threshold = np.inf
+        for batch_start in xrange(0, len(order), DTW_BATCH):
+            batch = order[batch_start : batch_start + DTW_BATCH]
+            if bounds[batch[0]] >= threshold:
+                break
+            batch = batch[~scored[batch] & (bounds[batch] < threshold)]
+            if not len(batch):
+                continue
+
+            score(batch)
+            exact.extend(distances[batch])
+            if self.dtw_prune and len(exact) >= DTW_EXACT:
+                threshold = max(np.partition(exact, DTW_EXACT - 1)
+                                [DTW_EXACT - 1], min_threshold)
+
+        best_distances = []
+        bucket_start = 0
+        for bucket_ids, signals in self.db_signals.values():
+            bucket_end = bucket_start + len(signals)
+            best = self._best_orientation(distances[bucket_start : bucket_end])
+            #with a pruned orientation, the best of the scored ones
+            #may not be the true distance
+            best_bound = self._best_orientation(bounds[bucket_start :
+                                                       bucket_end])
+            best[best > best_bound] = np.inf
+            best_distances.append(best)
+            bucket_start = bucket_end
+        return np.concatenate(best_distances)
+
+    def _protein_rows(self, prot_id):
+        """
+        Rows of the protein's signals (both orientations) in the
+        concatenated database signals
+        """
+        bucket_start = 0
+        for bucket_ids, signals in self.db_signals.values():
+            if prot_id in bucket_ids:
+                row = bucket_start + bucket_ids.index(prot_id)
+                if self.both_orientations:
+                    return np.array([row, row + len(bucket_ids)])
+                return np.array([row])
+            bucket_start += len(signals)
+
+
+def _rsquared_distances(context, candidates):
     """
-    Computes distance as 1 - R_squared statistic
+    Computes distances as 1 - R_squared statistic. Only the residuals
+    are computed per candidate, as a single matrix product
     """
-    residuals = distance.sqeuclidean(real_signal, model_signal)
-    mean = float(sum(real_signal)) / len(real_signal)
-    variance = sum((x - mean) ** 2 for x in real_signal)
-    return residuals / variance
+    residuals = (context.sq_norm[:, np.newaxis] -
+                 2 * np.dot(context.signals, candidates.T) +
+                 np.sum(candidates ** 2, axis=1))
+    return np.maximum(residuals, 0) / context.variance[:, np.newaxis]
+
+
+def _max_cross_correlation(context, candidates, max_lag):
+    """
+    Maximum cross-correlation between each of the context signals and
+    each of the candidate signals (matrix rows) over lags in
+    [-max_lag, max_lag], normalized by the signal norms.
+    Computed with batched FFTs
+    """
+    length = context.signals.shape[1]
+    candidates = candidates - np.mean(candidates, axis=1)[:, np.newaxis]
+    cand_norms = np.sqrt(np.sum(candidates ** 2, axis=1))
+
+    fft_len = 2 ** int(np.ceil(np.log2(2 * length - 1)))
+    cand_spectrum = np.fft.rfft(candidates, fft_len, axis=1)
+    query_spectrum = np.conj(np.fft.rfft(context.centered, fft_len, axis=1))
+
+    max_corr = np.empty((len(context.signals), len(candidates)))
+    for row in xrange(len(context.signals)):
+        correlation = np.fft.irfft(cand_spectrum * query_spectrum[row],
+                                   fft_len, axis=1)
+        lags = np.hstack((correlation[:, :max_lag + 1],
+                          correlation[:, fft_len - max_lag:]))
+        max_corr[row] = (np.max(lags, axis=1) /
+                         (np.sqrt(context.variance[row]) * cand_norms))
+    return max_corr
+
+
+def _lb_keogh(query, candidates, band):
+    """
+    Computes LB_Keogh lower bounds of the banded DTW distance
+    between the query and each of the candidate signals (matrix rows)
+    """
+    upper = query.copy()
+    lower = query.copy()
+    for shift in xrange(1, band + 1):
+        upper[:-shift] = np.maximum(upper[:-shift], query[shift:])
+        upper[shift:] = np.maximum(upper[shift:], query[:-shift])
+        lower[:-shift] = np.minimum(lower[:-shift], query[shift:])
+        lower[shift:] = np.minimum(lower[shift:], query[:-shift])
+
+    above = np.maximum(candidates - upper, 0)
+    below = np.maximum(lower - candidates, 0)
+    return np.sum(above ** 2 + below ** 2, axis=1)
+
+
+def _dtw_distances(query, candidates, band):
+    """
+    Sakoe-Chiba banded DTW (squared euclidean cost) between the query
+    and each of the candidate signals of the same length.
+    Vectorized over the candidates
+    """
+    num_cand, length = candidates.shape
+    prev_row = np.full((num_cand, length + 1), np.inf, dtype=candidates.dtype)
+    prev_row[:, 0] = 0
+    for i in xrange(length):
+        left = max(0, i - band)
+        right = min(length, i + band + 1)
+        cost = (candidates[:, left:right] - query[i]) ** 2
+
+        cur_row = np.full((num_cand, length + 1), np.inf,
+                          dtype=candidates.dtype)
+        cur_row[:, left + 1 : right + 1] = \
+            cost + np.minimum(prev_row[:, left:right],
+                              prev_row[:, left + 1 : right + 1])
+        for j in xrange(left + 1, right + 1):
+            cur_row[:, j] = np.minimum(cur_row[:, j],
+                                       cost[:, j - left - 1] +
+                                       cur_row[:, j - 1])
+        prev_row = cur_row
+
+    return prev_row[:, length]
@@ -0,0 +1,49 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+SVR-like model with an approximate RBF kernel and a linear regressor,
+which scales linearly with the number of training points
+"""
+
+from __future__ import print_function
+
+from nanoalign.svr import SvrBlockade
+import nanoalign.profiling as prof
+
+
+KERNEL_APPROXIMATIONS = ["nystroem", "fourier"]
+
+
+class KernelSvrBlockade(SvrBlockade):
+    def __init__(self):
+        super(KernelSvrBlockade, self).__init__()
+        self.name = "KernelSVR"
+
+    @prof.timed("ksvr.train")
+    def train(self, peptides, signals, gamma=0.001, n_components=300,
+              alpha=1.0, approximation="nystroem"):
+        """
+        Maps features into n_components dimensions approximating the RBF
+        kernel (Nystroem or random Fourier features) and fits ridge
+        regression
+        """
+        from sklearn.kernel_approximation import Nystroem, RBFSampler
+        from sklearn.linear_model import Ridge
+        from sklearn.pipeline import make_pipeline
+
+        assert approximation in KERNEL_APPROXIMATIONS
+        if approximation == "nystroem":
+            feature_map = Nystroem(gamma=gamma, n_components=n_components,
+                                   random_state=0)
+        else:
+            feature_map = RBFSampler(gamma=gamma, n_components=n_components,
+                                     random_state=0)
+        self.predictor = make_pipeline(feature_map, Ridge(alpha=alpha))
+        self.svr_cache = {}
+
+        train_features, train_signals = self._training_matrix(peptides,
+                                                              signals)
+        self.predictor.fit(train_features, train_signals)
+        print(self.predictor.score(train_features, train_signals))
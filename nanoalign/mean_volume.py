@@ -9,6 +9,7 @@ Mean volume model for theoretical signal generation
 import numpy as np
 
 from nanoalign.blockade_modlel import BlockadeModel
+import nanoalign.profiling as prof
 
 
 class MvBlockade(BlockadeModel):
@@ -17,6 +18,7 @@ class MvBlockade(BlockadeModel):
         self.name = "MeanVolume"
         self.cache = {}
 
+    @prof.timed("mv.peptide_signal")
     def peptide_signal(self, peptide):
         """
         Generates theoretical signal for a given peptide
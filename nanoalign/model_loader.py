@@ -7,22 +7,27 @@ Model load/store in pickle format
 """
 
 import pickle
+from importlib import import_module
 
-from nanoalign.svr import SvrBlockade
-from nanoalign.random_forest import RandomForestBlockade
 from nanoalign.mean_volume import MvBlockade
 
 
+#model name -> (module, class). Modules are imported only when
+#the model is loaded, so sklearn is not imported for the MV model
+MODELS = {"SVR": ("nanoalign.svr", "SvrBlockade"),
+          "KernelSVR": ("nanoalign.kernel_svr", "KernelSvrBlockade"),
+          "RandomForest": ("nanoalign.random_forest", "RandomForestBlockade"),
+          "Online": ("nanoalign.online", "OnlineBlockade")}
+
+
 def load_model(filename):
     if filename == "-":
         return MvBlockade()
 
     dump = pickle.load(open(filename, "rb"))
 
-    if dump.name == SvrBlockade().name:
-        model = SvrBlockade()
-    elif dump.name == RandomForestBlockade().name:
-        model = RandomForestBlockade()
+    module_name, class_name = MODELS[dump.name]
+    model = getattr(import_module(module_name), class_name)()
 
     model.load_from_dump(dump)
     return model
@@ -0,0 +1,115 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Linear k-mer model, which could be refined with new training
+nanospectra without the previous ones
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from nanoalign.blockade_modlel import BlockadeModel
+import nanoalign.profiling as prof
+
+
+class RidgeStatistics(object):
+    """
+    Ridge regression stored as its sufficient statistics (X'X, X'y
+    and moments of y), so new training points are added in time
+    proportional to their number. The last feature is the intercept,
+    which is not regularized
+    """
+    def __init__(self, num_features, alpha=1.0):
+        self.alpha = alpha
+        self.xtx = np.zeros((num_features, num_features))
+        self.xty = np.zeros(num_features)
+        self.count = 0
+        self.sum_y = 0.0
+        self.sum_yy = 0.0
+        self.coef = np.zeros(num_features)
+
+    def partial_fit(self, features, values):
+        self.xtx += np.dot(features.T, features)
+        self.xty += np.dot(features.T, values)
+        self.count += len(values)
+        self.sum_y += np.sum(values)
+        self.sum_yy += np.dot(values, values)
+
+        penalty = np.full(len(self.coef), float(self.alpha))
+        penalty[-1] = 0
+        self.coef = np.linalg.solve(self.xtx + np.diag(penalty), self.xty)
+
+    def predict(self, features):
+        return np.dot(features, self.coef)
+
+    def score(self):
+        """
+        R^2 on all the training points seen so far
+        """
+        residual = (self.sum_yy - 2 * np.dot(self.coef, self.xty) +
+                    np.dot(self.coef, np.dot(self.xtx, self.coef)))
+        total = self.sum_yy - self.sum_y ** 2 / self.count
+        return 1 - residual / total
+
+
+class OnlineBlockade(BlockadeModel):
+    def __init__(self):
+        super(OnlineBlockade, self).__init__()
+        self.name = "Online"
+        self.alphabet = sorted(self.volumes)
+        self.aa_index = {aa: i for i, aa in enumerate(self.alphabet)}
+
+    @prof.timed("online.train")
+    def train(self, peptides, signals, alpha=1.0):
+        """
+        Trains the model from scratch
+        """
+        self.predictor = RidgeStatistics(self.window * len(self.alphabet) + 1,
+                                         alpha)
+        self.partial_fit(peptides, signals)
+
+    @prof.timed("online.partial_fit")
+    def partial_fit(self, peptides, signals):
+        """
+        Refines the model with new training signals
+        """
+        if self.predictor is None:
+            return self.train(peptides, signals)
+
+        train_features, train_signals = self._training_matrix(peptides,
+                                                              signals)
+        self.predictor.partial_fit(train_features, train_signals)
+        print(self.predictor.score())
+
+    @prof.timed("online.peptide_signal")
+    def peptide_signal(self, peptide):
+        """
+        Generates theoretical signal for a given peptide
+        """
+        assert self.predictor is not None
+
+        signal = self.predictor.predict(self._peptide_to_features(peptide))
+        #normalize the signal's amplitude
+        signal = signal / np.std(signal)
+        return signal
+
+    def _peptide_to_features(self, peptide):
+        """
+        Converts peptide into a matrix with a row per k-mer: one-hot
+        encoded amino acids for each k-mer position and the intercept
+        """
+        flanked_peptide = ("-" * (self.window - 1) + peptide +
+                           "-" * (self.window - 1))
+        codes = np.array(map(self.aa_index.get, flanked_peptide))
+        num_peaks = len(peptide) + self.window - 1
+
+        features = np.zeros((num_peaks, self.window * len(self.alphabet) + 1))
+        rows = np.arange(num_peaks)
+        for pos in xrange(self.window):
+            features[rows, pos * len(self.alphabet) +
+                     codes[pos : pos + num_peaks]] = 1
+        features[:, -1] = 1
+        return features
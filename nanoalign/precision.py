@@ -0,0 +1,33 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Global floating point precision of the blockade traces, consensus
+signals and theoretical signals of the database
+"""
+
+import numpy as np
+
+
+_float_type = np.float64
+
+
+def set_float32(enabled=True):
+    """
+    Switches between single and double (default) precision.
+    Should be called before the blockades are read
+    """
+    global _float_type
+    _float_type = np.float32 if enabled else np.float64
+
+
+def float_type():
+    return _float_type
+
+
+def as_float(values):
+    """
+    Converts to an array of the current precision (copies only if needed)
+    """
+    return np.asarray(values, dtype=_float_type)
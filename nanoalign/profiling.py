@@ -0,0 +1,154 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Lightweight per-stage timing instrumentation
+"""
+
+import time
+import json
+import cProfile
+from collections import defaultdict
+from functools import wraps
+
+
+_enabled = False
+_seconds = defaultdict(float)
+_calls = defaultdict(int)
+_counters = defaultdict(int)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def reset():
+    _seconds.clear()
+    _calls.clear()
+    _counters.clear()
+
+
+def snapshot():
+    """
+    Returns the accumulated timings and counters, so they could be
+    sent from a worker process and merged in the parent
+    """
+    return dict(_seconds), dict(_calls), dict(_counters)
+
+
+def merge(stats):
+    """
+    Adds timings and counters returned by snapshot()
+    """
+    seconds, calls, counters = stats
+    for name, value in seconds.items():
+        _seconds[name] += value
+    for name, value in calls.items():
+        _calls[name] += value
+    for name, value in counters.items():
+        _counters[name] += value
+
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        _seconds[self.name] += time.time() - self.start
+        _calls[self.name] += 1
+
+
+class _NoStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """
+    Accumulates the wall time spent inside the block.
+    Stages could be nested, then the outer stage includes the inner one.
+    If profiling is disabled, a shared no-op context is returned
+    """
+    if not _enabled:
+        return _NO_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """
+    Decorator version of stage(). If profiling is disabled,
+    the function is called directly
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if _enabled:
+        _counters[name] += value
+
+
+def write_report(filename):
+    """
+    Writes the stage breakdown in JSON (if the file name ends with .json)
+    or TSV format
+    """
+    with open(filename, "w") as f:
+        if filename.endswith(".json"):
+            stages = dict((name, {"seconds": _seconds[name],
+                                  "calls": _calls[name]})
+                          for name in _seconds)
+            json.dump({"stages": stages, "counters": dict(_counters)}, f,
+                      indent=2, sort_keys=True)
+            return
+
+        f.write("Stage\tCalls\tSeconds\n")
+        for name, seconds in sorted(_seconds.items(), key=lambda i: -i[1]):
+            f.write("{0}\t{1}\t{2:.4f}\n".format(name, _calls[name], seconds))
+        f.write("\nCounter\tValue\n")
+        for name, value in sorted(_counters.items()):
+            f.write("{0}\t{1}\n".format(name, value))
+
+
+def run_profiled(function, report_file=None, cprofile_file=None):
+    """
+    Runs the function with the stage timers enabled if report_file
+    is given, and under cProfile if cprofile_file is given,
+    then writes the reports
+    """
+    if report_file:
+        enable()
+    profiler = cProfile.Profile() if cprofile_file else None
+
+    if profiler:
+        profiler.enable()
+    try:
+        with stage("total"):
+            result = function()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_file)
+        if report_file:
+            write_report(report_file)
+
+    return result
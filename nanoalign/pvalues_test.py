@@ -8,11 +8,12 @@ Performs identification test and report p-values
 
 from collections import defaultdict
 
-from Bio import SeqIO
 import numpy as np
 
 from nanoalign.identifier import Identifier
-from nanoalign.blockade import read_mat
+from nanoalign.blockade import iter_blockades, peek_peptide
+from nanoalign.results import cluster_result
+from nanoalign.shards import ShardedIdentifier
 import nanoalign.signal_proc as sp
 
 
@@ -20,6 +21,8 @@ def _make_database(db_file, peptide):
     """
     Reads protein database
     """
+    from Bio import SeqIO
+
     database = {}
     target_id = None
     for seq in SeqIO.parse(db_file, "fasta"):
@@ -30,53 +33,87 @@ def _make_database(db_file, peptide):
     return database, target_id
 
 
+def identify_clusters(identifier, clusters, target_id, top=1):
+    """
+    Scores the clusters against the identifier's database. Yields
+    (cluster, distances to all proteins, result) for each cluster,
+    see results.cluster_result
+    """
+    prot_ids = identifier.db_protein_ids()
+    for cluster in clusters:
+        distances = identifier.score_db_proteins(cluster.consensus,
+                                                 target_id)
+        yield (cluster, distances,
+               cluster_result(prot_ids, distances, target_id, top))
+
+
 def pvalues_test(blockades_file, cluster_size, blockade_model, db_file,
-                 single_blockades, ostream):
+                 single_blockades, ostream, distance="rsquared",
+                 both_orientations=False, results=None, shards=None,
+                 grid_size=None):
     """
-    Performs protein identification and report results
+    Performs protein identification and report results. Per-cluster
+    results are also passed to the results writer, if given.
+    If shard addresses are given, the database is searched
+    on the shard servers instead of db_file. With grid_size, signals
+    are compared on the canonical grid (see Identifier)
     """
     RANDOM_DB_SIZE = 10000
-    identifier = Identifier(blockade_model)
-
-    blockades = read_mat(blockades_file)
-    true_peptide = blockades[0].peptide
-    if db_file is None:
+    #the distance matrix and single blockade rankings need
+    #exact distances to all proteins
+    dtw_prune = not (single_blockades or (results and results.matrix_file))
+    identifier = Identifier(blockade_model, distance,
+                            both_orientations=both_orientations,
+                            grid_size=grid_size, dtw_prune=dtw_prune)
+
+    true_peptide, chunks = peek_peptide(iter_blockades(blockades_file))
+    if shards is not None:
+        assert not single_blockades
+        identifier = ShardedIdentifier(blockade_model, shards,
+                                       distance=distance,
+                                       both_orientations=both_orientations,
+                                       grid_size=grid_size)
+    elif db_file is None:
         identifier.random_database(true_peptide, RANDOM_DB_SIZE)
         target_id = "target"
-        db_len = RANDOM_DB_SIZE
     else:
         database, target_id = _make_database(db_file, true_peptide)
         identifier.set_database(database)
-        db_len = len(database)
 
-    clusters = sp.preprocess_blockades(blockades, cluster_size=cluster_size,
-                                       min_dwell=0.5, max_dwell=20)
+    clusters = sp.iter_clusters(chunks, cluster_size=cluster_size,
+                                min_dwell=0.5, max_dwell=20,
+                                keep_blockades=single_blockades)
 
     ostream.write("\nNo\tSize\tBest_id\t\tBest_dst\tTrg_dst\t\tTrg_rank\t"
                      "Trg_pval\n")
     p_values = []
     ranks = []
-    for num, cluster in enumerate(clusters):
-        db_ranking = identifier.rank_db_proteins(cluster.consensus)
-
-        target_rank = None
-        target_dist = None
-        for rank, (prot_id, prot_dist) in enumerate(db_ranking):
-            if prot_id == target_id:
-                target_rank = rank
-                target_dist = prot_dist
-        p_value = float(target_rank) / db_len
+    top = results.top if results else 1
+    if shards is not None:
+        prot_ids = None
+        identified = identifier.identify_clusters(clusters, true_peptide, top)
+    else:
+        prot_ids = identifier.db_protein_ids()
+        identified = identify_clusters(identifier, clusters, target_id, top)
+    for num, (cluster, distances, result) in enumerate(identified):
+        result.update({"file": blockades_file, "cluster": num + 1,
+                       "size": len(cluster.indices)})
+        if results:
+            results.write(result, distances, prot_ids)
 
-        p_values.append(p_value)
-        ranks.append(target_rank)
+        p_values.append(result["p_value"])
+        ranks.append(result["target_rank"] - 1)
 
         ostream.write("{0}\t{1}\t{2:10}\t{3:5.2f}\t\t{4:5.2f}\t\t{5}\t\t{6:6.4}\n"
-               .format(num + 1, len(cluster.blockades), db_ranking[0][0],
-                       db_ranking[0][1], target_dist, target_rank + 1, p_value))
+               .format(num + 1, len(cluster.indices), result["best_id"],
+                       result["best_dist"], result["target_dist"],
+                       result["target_rank"], result["p_value"]))
         if single_blockades:
-            _detalize_cluster(identifier, cluster, db_ranking[0][0],
+            _detalize_cluster(identifier, cluster, result["best_id"],
                               target_id, ostream)
 
+    if shards is not None:
+        identifier.close()
     ostream.write("\nMedian p-value: {0:7.4f}\n".format(np.median(p_values)))
     ostream.write("Median target rank: {0:d}\n".format(int(np.median(ranks))))
 
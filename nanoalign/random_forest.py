@@ -3,14 +3,12 @@
 #Released under the BSD license (see LICENSE file)
 
 from __future__ import print_function
-import random
 from itertools import chain
 
 import numpy as np
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.feature_selection import f_regression
 
 from nanoalign.blockade_modlel import BlockadeModel
+import nanoalign.profiling as prof
 
 
 class RandomForestBlockade(BlockadeModel):
@@ -20,22 +18,59 @@ class RandomForestBlockade(BlockadeModel):
         self.rf_cache = {}
 
 
-    def train(self, peptides, signals):
-        features = map(lambda p: self._peptide_to_features(p, shuffle=True),
-                       peptides)
-        train_features = np.array(sum(features, []))
+    @prof.timed("rf.train")
+    def train(self, peptides, signals, n_estimators=10, max_depth=None,
+              min_samples_leaf=1, n_jobs=1):
+        """
+        Trains random forest model. Trees are built in n_jobs
+        parallel jobs (-1 for all cores)
+        """
+        from sklearn.ensemble import RandomForestRegressor
+
+        self.predictor = RandomForestRegressor(n_estimators=n_estimators,
+                                               max_depth=max_depth,
+                                               min_samples_leaf=
+                                                    min_samples_leaf)
+        self._fit(peptides, signals, n_jobs)
+
+    @prof.timed("rf.update")
+    def update(self, peptides, signals, n_estimators=10, n_jobs=1):
+        """
+        Grows n_estimators more trees on the new training signals,
+        keeping the already trained ones (warm start)
+        """
+        assert self.predictor is not None
+
+        self.predictor.set_params(warm_start=True,
+                                  n_estimators=len(self.predictor
+                                                   .estimators_) +
+                                               n_estimators)
+        self._fit(peptides, signals, n_jobs)
+        self.predictor.set_params(warm_start=False)
+
+    def _fit(self, peptides, signals, n_jobs):
+        train_features, train_signals = self._training_matrix(peptides,
+                                                              signals)
+
+        #shuffle (volume, hydro) pairs within each window independently
+        #for every row, as the volume model is order-independent
+        num_rows = len(train_features)
+        pairs = train_features.reshape(num_rows, self.window, 2)
+        order = np.argsort(np.random.random((num_rows, self.window)), axis=1)
+        train_features = pairs[np.arange(num_rows)[:, np.newaxis],
+                               order].reshape(num_rows, -1)
 
         #regulzrisation
-        noise_features = []
-        for data in train_features:
-            noise_features.append(map(lambda f: f + random.gauss(0, 10), data))
+        noise_features = train_features + np.random.normal(0, 10,
+                                                           train_features.shape)
         ##
 
-        train_signals = np.array(sum(signals, []))
-        assert len(train_features) == len(train_signals)
-
-        self.predictor = RandomForestRegressor(n_estimators=10)
+        self.predictor.set_params(n_jobs=n_jobs)
         self.predictor.fit(noise_features, train_signals)
+        #signals are predicted row by row, where parallel jobs
+        #only add overhead
+        self.predictor.set_params(n_jobs=1)
+        self.rf_cache = {}
 
         #print(f_regression(noise_features, train_signals))
         print(self.predictor.feature_importances_)
@@ -50,18 +85,19 @@ class RandomForestBlockade(BlockadeModel):
             self.rf_cache[feature_vec] = self.predictor.predict(np_feature)[0]
         return self.rf_cache[feature_vec]
 
+    @prof.timed("rf.peptide_signal")
     def peptide_signal(self, peptide):
         """
         Generates theoretical signal of a given peptide
         """
         assert self.predictor is not None
 
-        features = self._peptide_to_features(peptide, shuffle=False)
+        features = self._peptide_to_features(peptide)
         signal = np.array(map(lambda x: self._rf_predict(x), features))
         #signal = signal / np.std(signal)
         return signal
 
-    def _peptide_to_features(self, peptide, shuffle):
+    def _peptide_to_features(self, peptide):
         volumes = map(self.volumes.get, peptide)
         hydro = map(self.hydro.get, peptide)
         num_peaks = len(volumes) + self.window - 1
@@ -73,14 +109,8 @@ class RandomForestBlockade(BlockadeModel):
         features = []
         for i in xrange(0, num_peaks):
             v = flanked_volumes[i : i + self.window]
-            #if shuffle:
-            #    random.shuffle(v)
-            #features.append(tuple(v))
-
             h = flanked_hydro[i : i + self.window]
             combined = zip(v, h)
-            if shuffle:
-                random.shuffle(combined)
             features.append(tuple(list(chain(*combined))))
 
         return features
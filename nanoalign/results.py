@@ -0,0 +1,152 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Structured output of identification results
+"""
+
+import sys
+import os
+import json
+import zipfile
+import tempfile
+from io import BytesIO
+
+import numpy as np
+
+
+RESULT_FIELDS = ["file", "cluster", "size", "best_id", "best_dist",
+                 "target_id", "target_dist", "target_rank", "p_value",
+                 "top_ids", "top_dists"]
+
+
+def cluster_result(prot_ids, distances, target_id=None, top=5):
+    """
+    Summarizes distances from a cluster to all database proteins
+    (in prot_ids order) without sorting the whole database.
+    Target rank is 1-based, p-value is (rank - 1) / database size
+    """
+    top = min(top, len(distances))
+    top_idx = np.argpartition(distances, top - 1)[:top]
+    top_idx = top_idx[np.lexsort((top_idx, distances[top_idx]))]
+    result = {"best_id": prot_ids[top_idx[0]],
+              "best_dist": float(distances[top_idx[0]]),
+              "target_id": target_id, "target_dist": None,
+              "target_rank": None, "p_value": None,
+              "top_ids": [prot_ids[i] for i in top_idx],
+              "top_dists": [float(distances[i]) for i in top_idx]}
+
+    if target_id is not None and target_id in prot_ids:
+        target_idx = prot_ids.index(target_id)
+        target_dist = distances[target_idx]
+        rank = (np.count_nonzero(distances < target_dist) +
+                np.count_nonzero(distances[:target_idx] == target_dist))
+        result.update({"target_dist": float(target_dist),
+                       "target_rank": rank + 1,
+                       "p_value": float(rank) / len(distances)})
+    return result
+
+
+class ResultsWriter(object):
+    """
+    Streams per-cluster results as TSV or JSON lines (if the file name
+    ends with .jsonl or .json; "-" stands for stdout). Optionally,
+    distances to all database proteins are stored as a float32 matrix
+    in an NPZ file (with "distances", "protein_ids", "files" and "clusters"
+    arrays). Matrix rows are spooled to a temporary file, so they are not
+    kept in memory
+    """
+    def __init__(self, out_file=None, matrix_file=None, top=5):
+        self.top = top
+        self.json = False
+        self.stream = None
+        if out_file is not None:
+            self.json = out_file.endswith((".jsonl", ".json"))
+            self.stream = sys.stdout if out_file == "-" else open(out_file, "w")
+            if not self.json:
+                self.stream.write("\t".join(RESULT_FIELDS) + "\n")
+
+        self.matrix_file = matrix_file
+        self.matrix_ids = None
+        self.matrix_keys = []
+        self.spool = None
+        if matrix_file is not None:
+            self.spool = tempfile.TemporaryFile(dir=_dirname(matrix_file))
+
+    def write(self, result, distances=None, prot_ids=None):
+        """
+        Writes a cluster result (see cluster_result, with "file", "cluster"
+        and "size" fields added). Distances to all database proteins
+        (in prot_ids order) are required for the distance matrix
+        """
+        if self.stream:
+            if self.json:
+                self.stream.write(json.dumps(result, sort_keys=True) + "\n")
+            else:
+                self.stream.write("\t".join(_tsv_value(result[field])
+                                            for field in RESULT_FIELDS) + "\n")
+
+        if self.spool:
+            if self.matrix_ids is None:
+                self.matrix_ids = list(prot_ids)
+            elif self.matrix_ids != list(prot_ids):
+                raise ValueError("Distance matrix requires the same database "
+                                 "for all clusters")
+            self.spool.write(np.asarray(distances, dtype="<f4").tostring())
+            self.matrix_keys.append((str(result["file"]), result["cluster"]))
+
+    def close(self):
+        if self.stream and self.stream is not sys.stdout:
+            self.stream.close()
+        if self.spool:
+            self._write_matrix()
+            self.spool.close()
+
+    def _write_matrix(self):
+        """
+        Builds .npy file from the spooled rows and copies it
+        into the NPZ archive chunk by chunk
+        """
+        shape = (len(self.matrix_keys), len(self.matrix_ids or []))
+        header = BytesIO()
+        np.lib.format.write_array_header_1_0(header, {"descr": "<f4",
+                                                      "fortran_order": False,
+                                                      "shape": shape})
+        with tempfile.NamedTemporaryFile(dir=_dirname(self.matrix_file)) \
+                as npy_file:
+            npy_file.write(header.getvalue())
+            self.spool.seek(0)
+            for chunk in iter(lambda: self.spool.read(1 << 20), b""):
+                npy_file.write(chunk)
+            npy_file.flush()
+
+            files = np.array([key[0] for key in self.matrix_keys])
+            clusters = np.array([key[1] for key in self.matrix_keys])
+            with zipfile.ZipFile(self.matrix_file, "w", zipfile.ZIP_STORED,
+                                 allowZip64=True) as npz:
+                npz.write(npy_file.name, "distances.npy")
+                npz.writestr("protein_ids.npy",
+                             _npy_bytes(np.array(self.matrix_ids or [])))
+                npz.writestr("files.npy", _npy_bytes(files))
+                npz.writestr("clusters.npy", _npy_bytes(clusters))
+
+
+def _dirname(filename):
+    return os.path.dirname(os.path.abspath(filename))
+
+
+def _npy_bytes(array):
+    buffer = BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def _tsv_value(value):
+    if value is None:
+        return "NA"
+    if isinstance(value, list):
+        return ",".join(map(_tsv_value, value))
+    if isinstance(value, float):
+        return "{0:.6g}".format(value)
+    return str(value)
@@ -0,0 +1,233 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Identification server that keeps the model and the database
+index loaded between requests
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import signal
+import multiprocessing
+import SocketServer
+import BaseHTTPServer
+
+import numpy as np
+
+from nanoalign.identifier import Identifier
+from nanoalign.arena import SignalArena
+from nanoalign.blockade import Blockade, iter_blockades, peek_peptide
+from nanoalign.pvalues_test import _make_database
+from nanoalign.results import cluster_result
+from nanoalign.shards import tcp_address
+import nanoalign.signal_proc as sp
+from nanoalign.precision import as_float
+
+
+#set in the server process before the worker pool is forked,
+#so the workers inherit the warm model. The database index
+#is attached from a shared arena
+_identifier = None
+_targets = None
+
+
+def init_identifier(identifier, arena=None):
+    """
+    Sets the identifier used by the request handlers and
+    precomputes the database index (or attaches it from the arena)
+    """
+    global _identifier, _targets
+    if arena is not None:
+        identifier.set_database_signals(arena.signals())
+    identifier._database_signals()
+    _identifier = identifier
+    _targets = dict((seq, prot_id) for prot_id, seq
+                    in identifier.database.items())
+
+
+def _init_worker(arena_path):
+    _identifier.set_database_signals(SignalArena(arena_path).signals())
+
+
+def identify_request(request):
+    """
+    Processes a single identification request:
+    {"nanospectra_file": path} or {"blockades": [{"eventTrace": [...],
+    "openPore": float, "ms_Dwell": float}, ...]}, optionally with
+    "cluster_size" (default 10), "top" (default 10) and "target" (database
+    protein id; by default taken from the nanospectra protein label).
+    Returns the results of each cluster (see results.cluster_result,
+    with "size" added) as a JSON-serializable dict
+    """
+    try:
+        if "nanospectra_file" in request:
+            chunks = iter_blockades(request["nanospectra_file"])
+        else:
+            chunks = [map(lambda b: Blockade("inline", 0, b["ms_Dwell"], 0,
+                                             b["openPore"],
+                                             as_float(b["eventTrace"]),
+                                             0, b.get("peptide")),
+                          request["blockades"])]
+        peptide, chunks = peek_peptide(chunks)
+
+        target_id = request.get("target")
+        if target_id is None and peptide:
+            target_id = _targets.get(peptide)
+
+        clusters = sp.iter_clusters(chunks, cluster_size=request
+                                                .get("cluster_size", 10),
+                                    min_dwell=0.5, max_dwell=20)
+        prot_ids = _identifier.db_protein_ids()
+        results = []
+        for cluster in clusters:
+            distances = _identifier.score_db_proteins(cluster.consensus,
+                                                      target_id)
+            result = cluster_result(prot_ids, distances, target_id,
+                                    request.get("top", 10))
+            result["size"] = len(cluster.indices)
+            results.append(result)
+
+        return {"target": target_id, "clusters": results}
+
+    except Exception as e:
+        return {"error": "{0}: {1}".format(type(e).__name__, e)}
+
+
+class _UnixHandler(SocketServer.StreamRequestHandler):
+    """
+    Newline-delimited JSON requests and responses
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.submit(json.loads(line))
+            except ValueError as e:
+                response = {"error": "Bad request: {0}".format(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class _HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON requests are POSTed to /identify
+    """
+    def do_POST(self):
+        if self.path != "/identify":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.getheader("content-length", 0))
+            response = self.server.submit(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            response = {"error": "Bad request: {0}".format(e)}
+
+        body = json.dumps(response)
+        self.send_response(400 if "error" in response else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print(self.address_string(), format % args, file=sys.stderr)
+
+
+class _PoolServerMixIn(SocketServer.ThreadingMixIn):
+    """
+    Handles each connection in a thread and runs the requests
+    on the pool of worker processes
+    """
+    daemon_threads = True
+    pool = None
+
+    def submit(self, request):
+        return self.pool.apply(identify_request, (request,))
+
+
+class UnixIdentificationServer(_PoolServerMixIn,
+                               SocketServer.UnixStreamServer):
+    pass
+
+
+class HttpIdentificationServer(_PoolServerMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Remote clients send the blockades inline; nanospectra files
+    could only be read from data_dir (if set)
+    """
+    data_dir = None
+
+    def submit(self, request):
+        if "nanospectra_file" in request:
+            path = _data_file(self.data_dir, request["nanospectra_file"])
+            if path is None and self.data_dir is None:
+                return {"error": "Bad request: nanospectra_file is not "
+                                 "allowed, send the blockades inline"}
+            if path is None:
+                return {"error": "Bad request: nanospectra_file is outside "
+                                 "of the data directory"}
+            request = dict(request, nanospectra_file=path)
+        return _PoolServerMixIn.submit(self, request)
+
+
+def _data_file(data_dir, filename):
+    """
+    Resolves the file name relative to data_dir. Returns None if
+    data_dir is not set or the file is outside of it
+    """
+    if data_dir is None:
+        return None
+    data_dir = os.path.realpath(data_dir)
+    path = os.path.realpath(os.path.join(data_dir, filename))
+    if not path.startswith(os.path.join(data_dir, "")):
+        return None
+    return path
+
+
+def serve(blockade_model, db_file, address, num_workers, http=False,
+          data_dir=None, **identifier_args):
+    """
+    Loads the database, forks the workers and serves the requests
+    until interrupted. Address is a UNIX socket path, or host:port
+    if http is set. HTTP clients may only request nanospectra files
+    from data_dir
+    """
+    tcp = tcp_address(address) if http else None
+    if http and tcp is None:
+        raise ValueError("HTTP address should be host:port, got {0}"
+                         .format(address))
+
+    database, _target = _make_database(db_file, None)
+    identifier = Identifier(blockade_model, **identifier_args)
+    identifier.set_database(database)
+    arena = SignalArena.build(identifier)
+    init_identifier(identifier, arena)
+
+    pool = multiprocessing.Pool(num_workers, _init_worker, (arena.path,))
+    if http:
+        server = HttpIdentificationServer(tcp, _HttpHandler)
+        server.data_dir = data_dir
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixIdentificationServer(address, _UnixHandler)
+    server.pool = pool
+
+    print("Serving {0} proteins on {1} with {2} workers"
+          .format(len(database), address, num_workers), file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not http and os.path.exists(address):
+            os.remove(address)
+        pool.terminate()
+        arena.close()
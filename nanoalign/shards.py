@@ -0,0 +1,250 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Sharded database search: each shard of the database is served
+by an independent process (possibly on another node), and
+the coordinator merges per-shard results into the global rankings
+"""
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import socket
+import signal
+import heapq
+import SocketServer
+
+import numpy as np
+
+from nanoalign.identifier import Identifier
+from nanoalign.results import cluster_result
+from nanoalign.precision import as_float
+
+
+def tcp_address(address):
+    """
+    Returns (host, port) if the address is host:port,
+    or None for a UNIX socket path
+    """
+    match = re.match(r"^([\w.-]+):(\d+)$", address)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def split_database(database, num_shards):
+    """
+    Splits the database into num_shards parts. The split depends only
+    on protein ids, so shards could be loaded independently
+    """
+    shards = [{} for _ in xrange(num_shards)]
+    for num, prot_id in enumerate(sorted(database)):
+        shards[num % num_shards][prot_id] = database[prot_id]
+    return shards
+
+
+def score_shard(identifier, targets, request):
+    """
+    Processes a shard request: {"signals": [consensus, ...], "top": k,
+    "target": target protein sequence or null, "target_dists": [distance
+    of each consensus to the target computed by the coordinator, ...]}.
+    For each cluster, returns the shard's top proteins and the number of
+    proteins closer than the target (for the shard with the target,
+    its exact rank and distance are returned instead)
+    """
+    prot_ids = identifier.db_protein_ids()
+    target_id = targets.get(request.get("target"))
+    num_signals = len(request["signals"])
+    target_dists = request.get("target_dists") or [None] * num_signals
+    clusters = []
+    for consensus, target_dist in zip(request["signals"], target_dists):
+        distances = identifier.score_db_proteins(as_float(consensus),
+                                                 target_id, target_dist)
+        result = cluster_result(prot_ids, distances, target_id,
+                                request.get("top", 10))
+        if target_id is not None:
+            closer = result["target_rank"] - 1
+        elif target_dist is not None:
+            closer = int(np.count_nonzero(distances < target_dist))
+        else:
+            closer = None
+        clusters.append({"top_ids": result["top_ids"],
+                         "top_dists": result["top_dists"],
+                         "target_id": target_id,
+                         "target_dist": result["target_dist"],
+                         "closer": closer})
+    return {"size": len(prot_ids), "clusters": clusters}
+
+
+class _ShardHandler(SocketServer.StreamRequestHandler):
+    """
+    Newline-delimited JSON requests and responses
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = score_shard(self.server.identifier,
+                                       self.server.targets, json.loads(line))
+            except Exception as e:
+                response = {"error": "{0}: {1}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class UnixShardServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TcpShardServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_shard(blockade_model, database, address, **identifier_args):
+    """
+    Builds the index of the database shard and serves the requests
+    until interrupted. Address is either a UNIX socket path
+    or host:port for TCP
+    """
+    identifier = Identifier(blockade_model, **identifier_args)
+    identifier.set_database(database)
+    identifier._database_signals()
+
+    tcp = tcp_address(address)
+    if tcp is not None:
+        server = TcpShardServer(tcp, _ShardHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixShardServer(address, _ShardHandler)
+    server.identifier = identifier
+    server.targets = dict((seq, prot_id) for prot_id, seq in database.items())
+
+    print("Serving shard of {0} proteins on {1}"
+          .format(len(database), address), file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if tcp is None and os.path.exists(address):
+            os.remove(address)
+
+
+class ShardedIdentifier(object):
+    """
+    Coordinator of the sharded search. Clusters are sent to all shards
+    in batches, and the per-shard top proteins are merged. The target
+    rank is exact: the coordinator computes the target distance once
+    and each shard counts its proteins that are closer
+    """
+    BATCH_SIZE = 64
+
+    def __init__(self, blockade_model, addresses, **identifier_args):
+        self.addresses = addresses
+        self.identifier = Identifier(blockade_model, **identifier_args)
+        self.connections = None
+
+    def identify_clusters(self, clusters, target_seq, top=1):
+        """
+        Yields (cluster, None, result) for each cluster, see
+        pvalues_test.identify_clusters and results.cluster_result
+        """
+        batch = []
+        for cluster in clusters:
+            batch.append(cluster)
+            if len(batch) == self.BATCH_SIZE:
+                for item in self._identify_batch(batch, target_seq, top):
+                    yield item
+                batch = []
+        for item in self._identify_batch(batch, target_seq, top):
+            yield item
+
+    def close(self):
+        for sock, stream in self.connections or []:
+            stream.close()
+            sock.close()
+        self.connections = None
+
+    def _identify_batch(self, clusters, target_seq, top):
+        if not clusters:
+            return []
+
+        consensus = map(lambda c: as_float(c.consensus).tolist(), clusters)
+        target_dists = None
+        if target_seq is not None:
+            target_dists = map(lambda c: self.identifier
+                               .protein_distance(as_float(c), target_seq),
+                               consensus)
+        responses = self._request({"signals": consensus, "top": top,
+                                   "target": target_seq,
+                                   "target_dists": target_dists})
+        db_size = sum(map(lambda r: r["size"], responses))
+
+        results = []
+        for num, cluster in enumerate(clusters):
+            shard_results = map(lambda r: r["clusters"][num], responses)
+            best = heapq.nsmallest(top, ((dist, prot_id)
+                                         for r in shard_results
+                                         for prot_id, dist
+                                         in zip(r["top_ids"], r["top_dists"])))
+            result = {"best_id": best[0][1], "best_dist": best[0][0],
+                      "target_id": None, "target_dist": None,
+                      "target_rank": None, "p_value": None,
+                      "top_ids": map(lambda b: b[1], best),
+                      "top_dists": map(lambda b: b[0], best)}
+
+            owners = filter(lambda r: r["target_id"] is not None,
+                            shard_results)
+            if owners:
+                rank = sum(map(lambda r: r["closer"], shard_results))
+                result.update({"target_id": owners[0]["target_id"],
+                               "target_dist": owners[0]["target_dist"],
+                               "target_rank": rank + 1,
+                               "p_value": float(rank) / db_size})
+            results.append((cluster, None, result))
+        return results
+
+    def _request(self, request):
+        """
+        Sends the request to all shards first, so they work in parallel,
+        then collects the responses
+        """
+        if self.connections is None:
+            self.connections = map(_connect, self.addresses)
+
+        message = json.dumps(request) + "\n"
+        for sock, _stream in self.connections:
+            sock.sendall(message)
+
+        responses = []
+        for address, (_sock, stream) in zip(self.addresses, self.connections):
+            line = stream.readline()
+            if not line:
+                raise IOError("Shard {0} closed the connection"
+                              .format(address))
+            response = json.loads(line)
+            if "error" in response:
+                raise IOError("Shard {0}: {1}".format(address,
+                                                      response["error"]))
+            responses.append(response)
+        return responses
+
+
+def _connect(address):
+    tcp = tcp_address(address)
+    if tcp is not None:
+        sock = socket.create_connection(tcp)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    return sock, sock.makefile("r")
@@ -14,21 +14,51 @@ import random
 from copy import deepcopy
 
 from nanoalign.blockade import BlockadeCluster
+import nanoalign.profiling as prof
+from nanoalign.precision import as_float
 
 
 def preprocess_blockades(blockades, cluster_size=10,
-                         min_dwell=0.5, max_dwell=20):
+                         min_dwell=0.5, max_dwell=20, seed=None):
     """
     The main function for blockade preprocessing.
     Does all preparations and output blockade clusters.
+    If seed is given, clusters do not depend on the global random state
     """
-    filtered = _filter_by_duration(blockades, min_dwell, max_dwell)
-    frac_current = _fractional_blockades(filtered)
-    clusters = _random_cluster(frac_current, cluster_size)
-    for cl in clusters:
-        cl.consensus = _normalize(_trim_flank_noise(cl.consensus))
+    return list(iter_clusters([blockades], cluster_size, min_dwell,
+                              max_dwell, keep_blockades=True, seed=seed))
 
-    return clusters
+
+def iter_clusters(blockade_chunks, cluster_size=10, min_dwell=0.5,
+                  max_dwell=20, keep_blockades=False, seed=None):
+    """
+    Generator version of preprocess_blockades for datasets that do
+    not fit into memory. Consumes chunks (lists) of blockades, such as
+    from blockade.iter_blockades, and yields clusters chunk by chunk.
+    Blockades are shuffled within a chunk together with the ones left
+    over from the previous chunk. Clusters store the indices of their
+    blockades in the input; the (fractional) blockades themselves are
+    kept only if keep_blockades is set
+    """
+    rng = random.Random(seed) if seed is not None else random
+    pending = []
+    offset = 0
+    for chunk in blockade_chunks:
+        with prof.stage("preprocess_blockades"):
+            selected = _dwell_indices(chunk, min_dwell, max_dwell)
+            fractional = _fractional_blockades(map(chunk.__getitem__,
+                                                   selected))
+            pending.extend(zip(map(lambda i: offset + i, selected),
+                               fractional))
+            offset += len(chunk)
+            clusters, pending = _random_cluster(pending, cluster_size,
+                                                keep_blockades, rng)
+            for cl in clusters:
+                cl.consensus = _normalize(_trim_flank_noise(cl.consensus))
+
+        prof.count("clusters", len(clusters))
+        for cl in clusters:
+            yield cl
 
 
 def discretize(signal, protein_length):
@@ -38,16 +68,19 @@ def discretize(signal, protein_length):
     WINDOW = 4
     num_peaks = protein_length + WINDOW - 1
 
-    discrete = []
     peak_shift = len(signal) / (num_peaks - 1)
-    for i in xrange(0, num_peaks):
-        signal_pos = i * (peak_shift - 1)
-        #discrete.append(signal[signal_pos])
-        left = max(0, signal_pos - peak_shift / 2)
-        right = min(len(signal), signal_pos + peak_shift / 2)
-        discrete.append(np.mean(signal[left:right]))
+    signal_pos = np.arange(num_peaks) * (peak_shift - 1)
+    left = np.clip(signal_pos - peak_shift / 2, 0, len(signal))
+    right = np.clip(signal_pos + peak_shift / 2, 0, len(signal))
 
-    return discrete
+    #window means from the cumulative sums (in double precision).
+    #Windows are empty if the signal is shorter than the number
+    #of peaks, their means are NaN
+    cum_sum = np.concatenate(([0], np.cumsum(signal, dtype=np.float64)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        discrete = (cum_sum[right] - cum_sum[left]) / (right - left)
+    discrete[right <= left] = np.nan
+    return discrete.tolist()
 
 
 def find_peaks(signal, minimum=False, ranged=False):
@@ -57,17 +90,18 @@ def find_peaks(signal, minimum=False, ranged=False):
     signal = np.array(signal)
     WINDOW = 10
 
-    peaks = []
-    for pos in xrange(WINDOW, len(signal) - WINDOW):
-        left = signal[pos - WINDOW: pos] - signal[pos]
-        right = signal[pos + 1: pos + WINDOW + 1] - signal[pos]
-
-        if not minimum:
-            if (left < 0).all() and (right < 0).all():
-                peaks.append((pos, abs(np.mean(left) + np.mean(right))))
-        else:
-            if (left > 0).all() and (right > 0).all():
-                peaks.append((pos, signal[pos]))
+    mask = _local_extrema(signal[np.newaxis, :], WINDOW, minimum)[0]
+    positions = np.nonzero(mask)[0] + WINDOW
+    if not minimum:
+        offsets = np.arange(1, WINDOW + 1)
+        left = (signal[positions[:, np.newaxis] - offsets[::-1]] -
+                signal[positions][:, np.newaxis])
+        right = (signal[positions[:, np.newaxis] + offsets] -
+                 signal[positions][:, np.newaxis])
+        scores = np.abs(np.mean(left, axis=1) + np.mean(right, axis=1))
+    else:
+        scores = signal[positions]
+    peaks = zip(positions.tolist(), scores.tolist())
 
     selected = sorted(peaks, key=lambda p: p[1], reverse=not minimum)
     xx = map(lambda p: p[0], selected)
@@ -77,17 +111,175 @@ def find_peaks(signal, minimum=False, ranged=False):
     return xx, yy
 
 
+def divisor_scores(numbers, divisors):
+    """
+    Scores how well each divisor divides the numbers (rows of
+    the matrix, NaN-padded): mean distance to the closest multiple
+    of the divisor, relative to the divisor. Lower is better
+    """
+    numbers = np.atleast_2d(np.array(numbers, dtype=float))
+    divisors = np.array(divisors, dtype=float)
+    with np.errstate(invalid="ignore"):
+        rems = np.mod(numbers[:, :, np.newaxis], divisors)
+        rems = np.minimum(rems, divisors - rems)
+    counts = np.sum(~np.isnan(numbers), axis=1)[:, np.newaxis]
+    return np.nansum(rems, axis=1) / np.maximum(counts, 1) / divisors
+
+
+FREQUENCY_FEATURES = [("num_peaks", int), ("peak_rate", float),
+                      ("peak_spacing", float), ("approx_divisor", float),
+                      ("dominant_freq", float)]
+
+
+def frequency_features(blockades, flank=0, chunk_size=256):
+    """
+    Computes frequency features for each blockade (fractional currents):
+    number of peaks and peaks per ms, median distance between adjacent
+    peaks and their approximate common divisor not exceeding it
+    (in trace samples),
+    and the dominant spectral frequency (per ms). The first and last
+    "flank" samples of each trace are ignored. Blockades of the same
+    trace length are processed together as matrices, so it is cheap
+    enough for QC filtering of the whole dataset.
+    Returns a structured array with FREQUENCY_FEATURES fields
+    """
+    WINDOW = 10
+    MAX_DIVISOR = 300
+
+    features = np.zeros(len(blockades), dtype=FREQUENCY_FEATURES)
+    by_length = defaultdict(list)
+    for num, blockade in enumerate(blockades):
+        by_length[len(blockade.eventTrace)].append(num)
+
+    divisors = np.arange(WINDOW + 1, MAX_DIVISOR)
+    for length, indices in by_length.items():
+        for chunk_start in xrange(0, len(indices), chunk_size):
+            chunk = indices[chunk_start : chunk_start + chunk_size]
+            traces = np.array(map(lambda i: blockades[i].eventTrace, chunk),
+                              dtype=float)[:, flank : length - flank]
+            dwells = (np.array(map(lambda i: blockades[i].ms_Dwell, chunk)) *
+                      traces.shape[1] / length)
+
+            rows, cols = np.nonzero(_local_extrema(traces, WINDOW, False))
+            num_peaks = np.bincount(rows, minlength=len(chunk))
+
+            same_row = rows[1:] == rows[:-1]
+            spacing_rows = rows[1:][same_row]
+            spacings = (cols[1:] - cols[:-1])[same_row]
+            num_spacings = np.bincount(spacing_rows, minlength=len(chunk))
+            first = np.cumsum(num_spacings) - num_spacings
+            padded = np.full((len(chunk), max(1, num_spacings.max())), np.nan)
+            padded[spacing_rows,
+                   np.arange(len(spacings)) - first[spacing_rows]] = spacings
+
+            ordered = np.sort(padded, axis=1)
+            all_rows = np.arange(len(chunk))
+            medians = (ordered[all_rows, np.maximum(num_spacings - 1, 0) / 2] +
+                       ordered[all_rows, num_spacings / 2]) / 2
+            #divisors above the typical spacing trivially fit small numbers
+            scores = divisor_scores(padded, divisors)
+            scores[divisors > medians[:, np.newaxis]] = np.inf
+
+            #traces shorter than two samples (after the flanks are
+            #removed) have no dominant frequency
+            dominant_freq = np.full(len(chunk), np.nan)
+            if traces.shape[1] > 1:
+                centered = traces - np.mean(traces, axis=1)[:, np.newaxis]
+                power = np.abs(np.fft.rfft(centered, axis=1)[:, 1:]) ** 2
+                dominant_freq = (np.argmax(power, axis=1) + 1) / dwells
+
+            features["num_peaks"][chunk] = num_peaks
+            features["peak_rate"][chunk] = num_peaks / dwells
+            features["peak_spacing"][chunk] = medians
+            features["approx_divisor"][chunk] = np.where(num_spacings > 0,
+                                    divisors[np.argmin(scores, axis=1)], np.nan)
+            features["dominant_freq"][chunk] = dominant_freq
+
+    return features
+
+
+def _local_extrema(signals, window, minimum):
+    """
+    For each row of the matrix, marks the positions in
+    [window, length - window) that are strictly greater (or smaller)
+    than the "window" neighbours on each side
+    """
+    length = signals.shape[1]
+    if length <= 2 * window:
+        return np.zeros((len(signals), max(0, length - 2 * window)),
+                        dtype=bool)
+    inner = signals[:, window : length - window]
+    mask = np.ones(inner.shape, dtype=bool)
+    for shift in xrange(1, window + 1):
+        left = signals[:, window - shift : length - window - shift]
+        right = signals[:, window + shift : length - window + shift]
+        if not minimum:
+            mask &= (left < inner) & (right < inner)
+        else:
+            mask &= (left > inner) & (right > inner)
+    return mask
+
+
+CorrelationStats = namedtuple("CorrelationStats", ["mean", "min", "max",
+                                                   "matrix"])
+
+
+def correlation_stats(signals_1, signals_2=None, block_size=1024,
+                      full_matrix=False):
+    """
+    Computes Pearson correlations between each of signals_1 and each of
+    signals_2 (or signals_1 itself) - equal length discretized signals.
+    Correlations are computed as products of centered, normalized
+    matrices in blocks of block_size x block_size, and only per-signal
+    mean, min and max are kept unless the full matrix is requested
+    """
+    def normalize_rows(signals):
+        signals = np.array(signals, dtype=float)
+        centered = signals - np.mean(signals, axis=1)[:, np.newaxis]
+        return centered / np.sqrt(np.sum(centered ** 2, axis=1))[:, np.newaxis]
+
+    rows = normalize_rows(signals_1)
+    columns = rows if signals_2 is None else normalize_rows(signals_2)
+
+    corr_sum = np.zeros(len(rows))
+    corr_min = np.full(len(rows), np.inf)
+    corr_max = np.full(len(rows), -np.inf)
+    matrix = np.empty((len(rows), len(columns))) if full_matrix else None
+
+    for row_start in xrange(0, len(rows), block_size):
+        row_block = rows[row_start : row_start + block_size]
+        row_end = row_start + len(row_block)
+        for col_start in xrange(0, len(columns), block_size):
+            col_block = columns[col_start : col_start + block_size]
+            corr = np.dot(row_block, col_block.T)
+
+            corr_sum[row_start:row_end] += np.sum(corr, axis=1)
+            corr_min[row_start:row_end] = \
+                    np.minimum(corr_min[row_start:row_end], np.min(corr, axis=1))
+            corr_max[row_start:row_end] = \
+                    np.maximum(corr_max[row_start:row_end], np.max(corr, axis=1))
+            if full_matrix:
+                matrix[row_start:row_end,
+                       col_start : col_start + len(col_block)] = corr
+
+    return CorrelationStats(corr_sum / len(columns), corr_min,
+                            corr_max, matrix)
+
+
+def _dwell_indices(blockades, min_time, max_time):
+    """
+    Indices of the blockades with dwell duration in the given range
+    """
+    return filter(lambda i: min_time <= blockades[i].ms_Dwell <= max_time,
+                  xrange(len(blockades)))
+
+
 def _filter_by_duration(blockades, min_time, max_time):
     """
     Filters blockades by dwell duration
     """
-    new_blockades = list(filter(lambda e: min_time <= e.ms_Dwell <= max_time,
-                             blockades))
-    filtered_prc = (100 * float(len(blockades) - len(new_blockades)) /
-                    len(blockades))
-    #print("Filtered by duration: {0:5.2f}%".format(filtered_prc),
-    #      file=sys.stderr)
-    return new_blockades
+    return map(blockades.__getitem__,
+               _dwell_indices(blockades, min_time, max_time))
 
 
 def _trim_flank_noise(signal):
@@ -142,7 +334,7 @@ def _get_consensus(signals):
     """
     Calculates consensus of multiple signals
     """
-    matrix = np.array(map(lambda e: e.eventTrace, signals))
+    matrix = as_float(map(lambda e: e.eventTrace, signals))
     medians = np.mean(matrix, axis=0)
     return medians
 
@@ -154,17 +346,23 @@ def _normalize(signal):
     return (signal - np.mean(signal)) / np.std(signal)
 
 
-def _random_cluster(blockades, bin_size):
+def _random_cluster(indexed_blockades, bin_size, keep_blockades, rng=random):
     """
-    Randomly splits blockades into clusters and calculates a consensus
+    Randomly splits (index, blockade) pairs into clusters and calculates
+    a consensus. Returns the clusters and the pairs left over
     """
     averages = []
-    blockades = deepcopy(blockades)
     if bin_size > 1:
-        random.shuffle(blockades)
-    for event_bin in xrange(0, len(blockades) / bin_size):
-        cl_blockades = blockades[event_bin*bin_size : (event_bin+1)*bin_size]
+        rng.shuffle(indexed_blockades)
+    num_bins = len(indexed_blockades) / bin_size
+    for event_bin in xrange(0, num_bins):
+        members = indexed_blockades[event_bin*bin_size :
+                                    (event_bin+1)*bin_size]
+        cl_indices = map(lambda m: m[0], members)
+        cl_blockades = map(lambda m: m[1], members)
         avg_signal = _get_consensus(cl_blockades)
-        averages.append(BlockadeCluster(avg_signal, cl_blockades))
+        averages.append(BlockadeCluster(avg_signal, cl_blockades
+                                        if keep_blockades else None,
+                                        cl_indices))
 
-    return averages
+    return averages, indexed_blockades[num_bins * bin_size:]
@@ -10,9 +10,9 @@ from __future__ import print_function
 from string import maketrans
 
 import numpy as np
-from sklearn.svm import SVR
 
 from nanoalign.blockade_modlel import BlockadeModel
+import nanoalign.profiling as prof
 
 
 class SvrBlockade(BlockadeModel):
@@ -30,19 +30,20 @@ class SvrBlockade(BlockadeModel):
             self.svr_cache[feature_vec] = self.predictor.predict(np_feature)[0]
         return self.svr_cache[feature_vec]
 
+    @prof.timed("svr.train")
     def train(self, peptides, signals, C=1000, gamma=0.001, epsilon=0.01):
         """
         Trains SVR model
         """
-        self.predictor = SVR(kernel="rbf", C=C, gamma=gamma, epsilon=epsilon)
-        features = map(lambda p: self._peptide_to_features(p), peptides)
-        train_features = np.array(sum(features, []))
-        train_signals = np.array(sum(signals, []))
-        assert len(train_features) == len(train_signals)
+        from sklearn.svm import SVR
 
+        self.predictor = SVR(kernel="rbf", C=C, gamma=gamma, epsilon=epsilon)
+        train_features, train_signals = self._training_matrix(peptides,
+                                                              signals)
         self.predictor.fit(train_features, train_signals)
         print(self.predictor.score(train_features, train_signals))
 
+    @prof.timed("svr.peptide_signal")
     def peptide_signal(self, peptide):
         """
         Generates theoretical signal for a given peptide
@@ -0,0 +1,75 @@
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Generates synthetic nanospectra from protein sequences
+using a blockade model
+"""
+
+import numpy as np
+
+from nanoalign.blockade import Blockade, write_mat, write_npy
+from nanoalign.mean_volume import MvBlockade
+
+
+def synthetic_blockades(peptide, num_blockades, blockade_model=None,
+                        seed=None, trace_len=10000, level=0.5,
+                        amplitude=0.05, noise=0.05, speed_var=0.3,
+                        max_flank=0.05, open_pore=-100.0, open_pore_var=2.0,
+                        dwell_median=3.0, dwell_var=0.5):
+    """
+    Yields synthetic blockades of the given peptide. The theoretical
+    signal (MV model by default) is scaled to the fractional blockade
+    level +- amplitude, stretched with log-normal variation of the
+    per-residue translocation speed, framed with open pore flanks of
+    random length (up to max_flank of the trace on each side) and covered
+    with gaussian noise. Open pore current is normal, dwell time is
+    log-normal. The output is deterministic for a given seed
+    """
+    if blockade_model is None:
+        blockade_model = MvBlockade()
+    rng = np.random.RandomState(seed)
+
+    theor_signal = np.array(blockade_model.peptide_signal(peptide))
+    theor_signal = ((theor_signal - np.mean(theor_signal)) /
+                    np.std(theor_signal))
+    fractional = level + amplitude * theor_signal
+    num_peaks = len(fractional)
+
+    start_point = 0.0
+    for _ in xrange(num_blockades):
+        flanks = rng.randint(0, int(max_flank * trace_len) + 1, size=2)
+        core_len = trace_len - np.sum(flanks)
+
+        peak_times = np.cumsum(rng.lognormal(0, speed_var, size=num_peaks))
+        sample_times = np.linspace(0, peak_times[-1], core_len)
+        positions = np.interp(sample_times, np.concatenate(([0], peak_times)),
+                              np.arange(num_peaks + 1)) - 0.5
+        core = np.interp(positions, np.arange(num_peaks), fractional)
+
+        frac_trace = np.concatenate((np.zeros(flanks[0]), core,
+                                     np.zeros(flanks[1])))
+        frac_trace += rng.normal(0, noise, size=trace_len)
+
+        pore_current = rng.normal(open_pore, open_pore_var)
+        trace = pore_current * (1 - frac_trace)
+        dwell = rng.lognormal(np.log(dwell_median), dwell_var)
+
+        yield Blockade("synthetic", start_point, dwell,
+                       float(np.mean(pore_current - trace)), pore_current,
+                       trace, 1.0, peptide)
+        start_point += dwell
+
+
+def write_synthetic(filename, peptide, num_blockades, **kwargs):
+    """
+    Generates synthetic blockades and stores them in mat or (if the file
+    name ends with .npy) native format. Native files are written
+    blockade by blockade, so their size is not limited by memory
+    """
+    blockades = synthetic_blockades(peptide, num_blockades, **kwargs)
+    if filename.endswith(".npy"):
+        write_npy(blockades, filename, num_blockades)
+    else:
+        write_mat(list(blockades), filename)
@@ -15,7 +15,6 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
-from scipy.spatial import distance
 
 nanoalign_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, nanoalign_root)
@@ -38,17 +37,8 @@ def correlation(mat_file_1, mat_file_2):
     blockades_2 = sp._filter_by_duration(blockades_2, 0.5, 20)
     blockades_2 = map(lambda b: sp.discretize(sp._trim_flank_noise(b.eventTrace), 20), blockades_2)
 
-    self_corr = []
-    cross_corr = []
-    for blockade in blockades_1:
-        block_self = []
-        for other in blockades_1:
-            block_self.append(1 - distance.correlation(blockade, other))
-        block_cross = []
-        for other in blockades_2:
-            block_cross.append(1 - distance.correlation(blockade, other))
-        self_corr.append(np.mean(block_self))
-        cross_corr.append(np.mean(block_cross))
+    self_corr = sp.correlation_stats(blockades_1).mean
+    cross_corr = sp.correlation_stats(blockades_1, blockades_2).mean
 
     mean_self = np.median(self_corr)
     mean_cross = np.median(cross_corr)
@@ -56,14 +56,7 @@ def gcd_fuzz(numbers):
     """
     Computes "approximate" common divisor
     """
-    vals = []
-    for div in xrange(1, 300):
-        rems = []
-        for num in numbers:
-            rem = min(num % div, (num // div + 1) * div - num)
-            rems.append((float(rem)))
-
-        vals.append(np.mean(rems) / div)
+    vals = list(sp.divisor_scores(numbers, np.arange(1, 300))[0])
 
     gcd_x, gcd_y = sp.find_peaks(vals, minimum=True, ranged=True)
     gcds = filter(lambda x: 40 < x < 500, gcd_x)
@@ -79,22 +72,18 @@ def frequency_distribution(blockades_file, detailed):
     blockades = sp._fractional_blockades(blockades)
     blockades = sp._filter_by_duration(blockades, 0.5, 20)
 
-    peaks_count = {}
-    for blockade in blockades:
-        if detailed:
+    if detailed:
+        for blockade in blockades:
             detailed_plots(blockade)
 
-        signal = blockade.eventTrace[1000:-1000]
-        xx, yy = sp.find_peaks(signal)
-        peaks_count[blockade] = len(xx) / blockade.ms_Dwell * 5 / 4
-
-    mean = np.mean(peaks_count.values())
-    errors = map(lambda e: peaks_count[e] - mean, blockades)
-    lengths = map(lambda e: e.ms_Dwell, blockades)
+    features = sp.frequency_features(blockades, flank=1000)
+    lengths = np.array(map(lambda e: e.ms_Dwell, blockades))
+    peaks_count = features["num_peaks"] / lengths * 5 / 4
+    errors = peaks_count - np.mean(peaks_count)
 
     f, (s1, s2) = plt.subplots(2)
     s1.scatter(lengths, errors)
-    s2.hist(peaks_count.values(), bins=100)
+    s2.hist(peaks_count, bins=100)
     plt.show()
 
 
@@ -0,0 +1,551 @@
+#!/usr/bin/env python2.7
+
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Benchmarks the identification hot paths on synthetic data
+and compares the results with a previous baseline
+"""
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+import resource
+import socket
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+nanoalign_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, nanoalign_root)
+from nanoalign.__version__ import __version__
+import nanoalign.signal_proc as sp
+import nanoalign.precision as precision
+from nanoalign.blockade import read_mat
+from nanoalign.identifier import Identifier, DISTANCES
+from nanoalign.pvalues_test import pvalues_test
+from nanoalign.results import cluster_result
+from nanoalign.mean_volume import MvBlockade
+from nanoalign.svr import SvrBlockade
+from nanoalign.kernel_svr import KernelSvrBlockade
+from nanoalign.random_forest import RandomForestBlockade
+from nanoalign.online import OnlineBlockade
+from nanoalign.synthetic import write_synthetic
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+DB_SIZES = [100, 1000, 10000]
+GRID_SIZE = 100
+
+#what identify.py does before the first cluster with the MV model;
+#prints the heavy modules that got imported
+STARTUP_CODE = ("import sys; sys.path.insert(0, {0!r}); import identify; "
+                "from nanoalign.model_loader import load_model; "
+                "load_model('-'); "
+                "print(','.join(m for m in ['matplotlib', 'sklearn', 'Bio'] "
+                "if m in sys.modules))".format(nanoalign_root))
+
+
+class BenchmarkData(object):
+    """
+    Synthetic datasets shared by all benchmarks
+    """
+    def __init__(self, work_dir, num_nanospectra, train_size, seed):
+        rng = random.Random(seed)
+        def random_protein(length):
+            return "".join(rng.choice(AMINO_ACIDS) for _ in xrange(length))
+
+        self.peptide = random_protein(60)
+        self.num_nanospectra = num_nanospectra
+        self.mat_file = os.path.join(work_dir, "nanospectra.mat")
+        write_synthetic(self.mat_file, self.peptide, num_nanospectra,
+                        seed=seed)
+        self.blockades = read_mat(self.mat_file)
+
+        random.seed(seed)
+        self.clusters = sp.preprocess_blockades(self.blockades,
+                                                cluster_size=10)
+        self.single_clusters = sp.preprocess_blockades(self.blockades[:train_size],
+                                                       cluster_size=1)
+        self.train_peptides = [self.peptide] * len(self.single_clusters)
+        self.train_signals = map(lambda c: sp.discretize(c.consensus,
+                                                         len(self.peptide)),
+                                 self.single_clusters)
+
+        self.databases = {}
+        for db_size in DB_SIZES:
+            database = {"target": self.peptide}
+            for i in xrange(db_size - 1):
+                length = len(self.peptide) + rng.randint(-10, 10)
+                database["decoy_{0}".format(i)] = random_protein(length)
+            self.databases[db_size] = database
+
+        self.db_file = os.path.join(work_dir, "database.fasta")
+        with open(self.db_file, "w") as f:
+            for prot_id, prot_seq in self.databases[DB_SIZES[1]].items():
+                f.write(">{0}\n{1}\n".format(prot_id, prot_seq))
+
+        self.proteins = map(lambda i: random_protein(len(self.peptide)),
+                            xrange(100))
+        self.models = {"mv": MvBlockade(), "svr": SvrBlockade(),
+                       "ksvr": KernelSvrBlockade(),
+                       "rf": RandomForestBlockade(),
+                       "online": OnlineBlockade()}
+        self.models["svr"].train(self.train_peptides, self.train_signals)
+        self.models["ksvr"].train(self.train_peptides, self.train_signals)
+        self.models["rf"].train(self.train_peptides, self.train_signals)
+        self.models["online"].train(self.train_peptides, self.train_signals)
+
+
+def _bench_startup(data):
+    def run():
+        subprocess.check_output([sys.executable, "-c", STARTUP_CODE])
+    return run, 1, "starts"
+
+
+def _bench_read_mat(data):
+    return (lambda: read_mat(data.mat_file)), data.num_nanospectra, "blockades"
+
+
+def _bench_preprocess(data):
+    return ((lambda: sp.preprocess_blockades(data.blockades, cluster_size=10)),
+            len(data.blockades), "blockades")
+
+
+def _bench_discretize(data):
+    def run():
+        for cluster in data.clusters:
+            sp.discretize(cluster.consensus, len(data.peptide))
+    return run, len(data.clusters), "clusters"
+
+
+def _bench_peptide_signal(model_name):
+    def factory(data):
+        model = data.models[model_name]
+        def run():
+            for cache in ["cache", "svr_cache", "rf_cache"]:
+                if hasattr(model, cache):
+                    setattr(model, cache, {})
+            for protein in data.proteins:
+                model.peptide_signal(protein)
+        return run, len(data.proteins), "proteins"
+    return factory
+
+
+def _bench_rank(db_size, float32=False, grid_size=None):
+    def factory(data):
+        precision.set_float32(float32)
+        consensuses = map(lambda c: precision.as_float(c.consensus),
+                          data.clusters)
+        identifier = Identifier(data.models["mv"], grid_size=grid_size)
+        identifier.set_database(data.databases[db_size])
+        identifier.rank_db_proteins(consensuses[0])
+        def run():
+            for consensus in consensuses:
+                identifier.rank_db_proteins(consensus)
+        return run, db_size * len(data.clusters), "proteins"
+    return factory
+
+
+def _bench_train(model_class):
+    def factory(data):
+        def run():
+            model_class().train(data.train_peptides, data.train_signals)
+        return run, len(data.train_signals), "nanospectra"
+    return factory
+
+
+def _bench_pvalues_test(data):
+    def run():
+        pvalues_test(data.mat_file, 10, data.models["mv"], data.db_file,
+                     False, open(os.devnull, "w"))
+    return run, len(data.clusters), "clusters"
+
+
+BENCHMARKS = [("startup", _bench_startup),
+              ("read_mat", _bench_read_mat),
+              ("preprocess_blockades", _bench_preprocess),
+              ("discretize", _bench_discretize),
+              ("peptide_signal_mv", _bench_peptide_signal("mv")),
+              ("peptide_signal_svr", _bench_peptide_signal("svr")),
+              ("peptide_signal_ksvr", _bench_peptide_signal("ksvr")),
+              ("peptide_signal_rf", _bench_peptide_signal("rf")),
+              ("peptide_signal_online", _bench_peptide_signal("online"))] + \
+             [("rank_db_proteins_{0}".format(size), _bench_rank(size))
+              for size in DB_SIZES] + \
+             [("rank_db_proteins_{0}_float32".format(DB_SIZES[-1]),
+               _bench_rank(DB_SIZES[-1], float32=True)),
+              ("rank_db_proteins_{0}_grid".format(DB_SIZES[-1]),
+               _bench_rank(DB_SIZES[-1], grid_size=GRID_SIZE)),
+              ("train_svr", _bench_train(SvrBlockade)),
+              ("train_ksvr", _bench_train(KernelSvrBlockade)),
+              ("train_rf", _bench_train(RandomForestBlockade)),
+              ("train_online", _bench_train(OnlineBlockade)),
+              ("pvalues_test", _bench_pvalues_test)]
+
+
+def _run_benchmark(factory, data, repeats, seed, conn):
+    """
+    Runs a benchmark in a child process, so the peak memory
+    is measured independently
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    run, num_units, unit = factory(data)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timings = []
+    for _ in xrange(repeats):
+        start = time.time()
+        run()
+        timings.append(time.time() - start)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = min(timings)
+    conn.send({"seconds": seconds, "unit": unit,
+               "throughput": num_units / seconds if seconds else float("inf"),
+               "peak_rss_mb": peak_rss / 1024.0,
+               "rss_increase_mb": (peak_rss - start_rss) / 1024.0})
+    conn.close()
+
+
+def run_benchmarks(data, names, repeats, seed):
+    """
+    Runs the selected benchmarks and returns their results
+    """
+    results = {}
+    for name, factory in BENCHMARKS:
+        if names and name not in names:
+            continue
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_run_benchmark,
+                                          args=(factory, data, repeats,
+                                                seed, child_conn))
+        process.start()
+        results[name] = parent_conn.recv()
+        process.join()
+
+        print("{0:32}{1:12.4f} s{2:14.1f} {3}/s{4:10.1f} MB"
+              .format(name, results[name]["seconds"],
+                      results[name]["throughput"], results[name]["unit"],
+                      results[name]["peak_rss_mb"]), file=sys.stderr)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares results with the baseline. Throughput drops and
+    peak memory increases above the tolerance are reported
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append("{0}: throughput {1:.1f} -> {2:.1f} {3}/s"
+                               .format(name, old["throughput"],
+                                       result["throughput"], result["unit"]))
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append("{0}: peak memory {1:.1f} -> {2:.1f} MB"
+                               .format(name, old["peak_rss_mb"],
+                                       result["peak_rss_mb"]))
+    return regressions
+
+
+def check_startup(results, budget):
+    """
+    Checks that identify.py with the MV model starts within the time
+    budget and imports neither matplotlib, sklearn nor Bio
+    """
+    problems = []
+    if results["startup"]["seconds"] > budget:
+        problems.append("startup takes {0:.3f} s, budget is {1:.3f} s"
+                        .format(results["startup"]["seconds"], budget))
+    heavy = subprocess.check_output([sys.executable, "-c",
+                                     STARTUP_CODE]).strip()
+    if heavy:
+        problems.append("startup imports " + heavy)
+    return problems
+
+
+def check_long_proteins(data):
+    """
+    Checks that proteins too long for the consensus to be discretized
+    (fewer samples than peaks) are ranked last with all distances
+    instead of failing the identification
+    """
+    problems = []
+    consensus = data.clusters[0].consensus
+    num_samples = len(consensus)
+    database = {"target": data.peptide,
+                "long": data.peptide * (num_samples / len(data.peptide) + 1)}
+    try:
+        discrete = sp.discretize(consensus, len(database["long"]))
+        if len(discrete) != len(database["long"]) + 3:
+            problems.append("discretize returns a wrong number of peaks "
+                            "for a short signal")
+    except Exception as e:
+        problems.append("discretize fails for a short signal with "
+                        "{0}: {1}".format(type(e).__name__, e))
+    for distance in DISTANCES:
+        identifier = Identifier(data.models["mv"], distance)
+        identifier.set_database(database)
+        try:
+            distances = identifier.score_db_proteins(consensus)
+        except Exception as e:
+            problems.append("{0}: scoring a protein longer than the signal "
+                            "fails with {1}: {2}"
+                            .format(distance, type(e).__name__, e))
+            continue
+        long_dist = distances[identifier.db_protein_ids().index("long")]
+        if long_dist != np.inf:
+            problems.append("{0}: a protein longer than the signal has "
+                            "distance {1}".format(distance, long_dist))
+    return problems
+
+
+def check_server_float32(data, work_dir):
+    """
+    Starts identify-server.py in single precision and checks that
+    a request over the UNIX socket gets a complete JSON response
+    """
+    problems = []
+    address = os.path.join(work_dir, "server.sock")
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(nanoalign_root,
+                                            "identify-server.py"),
+                               "-", data.db_file, address, "-w", "1",
+                               "--float32"], stderr=open(os.devnull, "w"))
+    try:
+        for _ in xrange(600):
+            if os.path.exists(address) or server.poll() is not None:
+                break
+            time.sleep(0.1)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(120)
+        sock.connect(address)
+        sock.sendall(json.dumps({"nanospectra_file": data.mat_file,
+                                 "top": 3}) + "\n")
+        line = sock.makefile("r").readline()
+        sock.close()
+        if not line:
+            problems.append("float32 server closed the connection "
+                            "without a response")
+        else:
+            response = json.loads(line)
+            if "error" in response:
+                problems.append("float32 server: " + response["error"])
+            elif not response["clusters"] or \
+                    response["clusters"][0]["target_rank"] is None:
+                problems.append("float32 server response has no "
+                                "target rank")
+    except (IOError, OSError, ValueError) as e:
+        problems.append("float32 server round trip fails with {0}: {1}"
+                        .format(type(e).__name__, e))
+    finally:
+        if server.poll() is None:
+            server.terminate()
+        server.wait()
+    return problems
+
+
+def float32_accuracy(data, seed):
+    """
+    Identifies the synthetic nanospectra with all distances in double
+    and single precision (from reading the traces on). Prints the
+    maximum change of a protein's rank and returns the maximum absolute
+    difference between the distances
+    """
+    max_error = 0.0
+    max_rank_change = 0
+    database = data.databases[DB_SIZES[1]]
+    try:
+        for distance in DISTANCES:
+            scores = []
+            for float32 in [False, True]:
+                precision.set_float32(float32)
+                random.seed(seed)
+                clusters = sp.preprocess_blockades(read_mat(data.mat_file),
+                                                   cluster_size=10)
+                identifier = Identifier(data.models["mv"], distance,
+                                        dtw_prune=False)
+                identifier.set_database(database)
+                scores.append(np.array(map(lambda c: identifier
+                                           .score_db_proteins(c.consensus),
+                                           clusters), dtype=float))
+
+            ranks = map(lambda s: np.argsort(np.argsort(s, axis=1,
+                                                        kind="mergesort"),
+                                             axis=1), scores)
+            max_error = max(max_error, np.max(np.abs(scores[0] - scores[1])))
+            max_rank_change = max(max_rank_change,
+                                  np.max(np.abs(ranks[0] - ranks[1])))
+            print("float32 {0:24}max distance error {1:.2e}, max rank "
+                  "change {2}".format(distance, max_error, max_rank_change),
+                  file=sys.stderr)
+    finally:
+        precision.set_float32(False)
+    return max_error
+
+
+def kernel_svr_tradeoff(data):
+    """
+    Compares SVR with the approximate kernel against the exact one:
+    training time, correlation of the theoretical signals with the exact
+    SVR signals and the median target rank of the synthetic clusters
+    """
+    exact_signals = map(data.models["svr"].peptide_signal, data.proteins)
+    print("Model\tTrain_s\tSignal_corr\tMedian_rank", file=sys.stderr)
+    for name, model_class in [("svr", SvrBlockade),
+                              ("ksvr", KernelSvrBlockade)]:
+        start = time.time()
+        model_class().train(data.train_peptides, data.train_signals)
+        train_time = time.time() - start
+
+        model = data.models[name]
+        correlation = np.mean(map(lambda s1, s2: np.corrcoef(s1, s2)[0, 1],
+                                  exact_signals,
+                                  map(model.peptide_signal, data.proteins)))
+        identifier = Identifier(model)
+        identifier.set_database(data.databases[DB_SIZES[1]])
+        ranks = map(lambda c: cluster_result(identifier.db_protein_ids(),
+                                             identifier.score_db_proteins(
+                                                 c.consensus),
+                                             "target")["target_rank"],
+                    data.clusters)
+        print("{0}\t{1:.3f}\t{2:.4f}\t{3}".format(name, train_time,
+                                                  correlation,
+                                                  np.median(ranks)),
+              file=sys.stderr)
+
+
+def grid_accuracy(data, seed):
+    """
+    Compares the canonical grid index with the per-length one on
+    a database with a wide range of protein lengths (a bucket per length):
+    ranking time, median target rank, mean Spearman correlation
+    of the distances and the overlap of the top 10 proteins
+    """
+    TOP = 10
+    rng = random.Random(seed)
+    database = {"target": data.peptide}
+    for i in xrange(DB_SIZES[1] - 1):
+        length = rng.randint(len(data.peptide) / 2, len(data.peptide) * 5)
+        database["decoy_{0}".format(i)] = \
+                "".join(rng.choice(AMINO_ACIDS) for _ in xrange(length))
+
+    scores = {}
+    print("\nIndex\tBuckets\tRank_s\tMedian_rank", file=sys.stderr)
+    for name, grid_size in [("length", None), ("grid", GRID_SIZE)]:
+        identifier = Identifier(data.models["mv"], grid_size=grid_size)
+        identifier.set_database(database)
+        buckets = len(identifier._database_signals())
+        start = time.time()
+        scores[name] = np.array(map(lambda c: identifier
+                                    .score_db_proteins(c.consensus),
+                                    data.clusters))
+        rank_time = time.time() - start
+        target = identifier.db_protein_ids().index("target")
+        ranks = np.sum(scores[name] < scores[name][:, target:target + 1],
+                       axis=1)
+        print("{0}\t{1}\t{2:.3f}\t{3}".format(name, buckets, rank_time,
+                                             np.median(ranks)),
+              file=sys.stderr)
+
+    ranks = map(lambda s: np.argsort(np.argsort(s, axis=1), axis=1),
+                [scores["length"], scores["grid"]])
+    spearman = np.mean(map(lambda r1, r2: np.corrcoef(r1, r2)[0, 1],
+                           ranks[0], ranks[1]))
+    overlap = np.mean(map(lambda r1, r2: len(set(np.argsort(r1)[:TOP]) &
+                                             set(np.argsort(r2)[:TOP])),
+                          scores["length"], scores["grid"])) / TOP
+    print("grid vs length: distance Spearman correlation {0:.4f}, top {1} "
+          "overlap {2:.2f}".format(spearman, TOP, overlap), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nano-Align benchmarks "
+                                     "on synthetic data", formatter_class= \
+                                     argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="store results as a JSON baseline")
+    parser.add_argument("-b", "--baseline", dest="baseline", default=None,
+                        help="previous JSON baseline to compare with")
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=float,
+                        default=0.2, help="relative change reported "
+                        "as a regression")
+    parser.add_argument("-n", "--num-nanospectra", dest="num_nanospectra",
+                        type=int, default=200, help="synthetic nanospectra")
+    parser.add_argument("--train-size", dest="train_size", type=int,
+                        default=50, help="nanospectra for model training")
+    parser.add_argument("-r", "--repeats", dest="repeats", type=int,
+                        default=3, help="repeats per benchmark (best is taken)")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="random seed")
+    parser.add_argument("--startup-budget", dest="startup_budget",
+                        type=float, default=0.5, help="maximum identify.py "
+                        "startup time (s) with the MV model")
+    parser.add_argument("--float32-bound", dest="float32_bound", type=float,
+                        default=1e-4, help="maximum difference between "
+                        "single and double precision distances")
+    parser.add_argument("--only", dest="only", default=None,
+                        help="comma-separated list of benchmarks to run")
+    parser.add_argument("--version", action="version", version=__version__)
+    args = parser.parse_args()
+
+    max_error = None
+    long_problems = []
+    server_problems = []
+    work_dir = tempfile.mkdtemp()
+    try:
+        data = BenchmarkData(work_dir, args.num_nanospectra,
+                             args.train_size, args.seed)
+        names = args.only.split(",") if args.only else None
+        results = run_benchmarks(data, names, args.repeats, args.seed)
+        if not names or "float32_accuracy" in names:
+            max_error = float32_accuracy(data, args.seed)
+        if not names or "kernel_svr_tradeoff" in names:
+            kernel_svr_tradeoff(data)
+        if not names or "grid_accuracy" in names:
+            grid_accuracy(data, args.seed)
+        if not names or "long_proteins" in names:
+            long_problems = check_long_proteins(data)
+        if not names or "server_float32" in names:
+            server_problems = check_server_float32(data, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if max_error is not None and max_error > args.float32_bound:
+        regressions.append("float32 distances differ by {0:.2e}, bound is "
+                           "{1:.2e}".format(max_error, args.float32_bound))
+    regressions.extend(long_problems)
+    regressions.extend(server_problems)
+    if "startup" in results:
+        regressions.extend(check_startup(results, args.startup_budget))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions.extend(find_regressions(results, json.load(f),
+                                                args.tolerance))
+    for regression in regressions:
+        print("REGRESSION", regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
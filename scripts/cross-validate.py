@@ -5,95 +5,286 @@
 #Released under the BSD license (see LICENSE file)
 
 """
-Cross-validation of SVR model
+Cross-validation of SVR, random forest and online models
 """
 
 from __future__ import print_function
 import sys
 import os
 import argparse
+import json
+import hashlib
+import random
+import multiprocessing
+from collections import OrderedDict
+from itertools import product
 
 import numpy as np
 
 nanoalign_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, nanoalign_root)
 from nanoalign.__version__ import __version__
-import nanoalign.signal_proc as sp
-from nanoalign.blockade import read_mat
-from nanoalign.pvalues_test import pvalues_test
+from nanoalign.cache import SignalCache, preprocessed_signals, file_sha1
+from nanoalign.identifier import Identifier
+from nanoalign.pvalues_test import _make_database, identify_clusters
 from nanoalign.model_loader import store_model
 from nanoalign.svr import SvrBlockade
+from nanoalign.random_forest import RandomForestBlockade
+from nanoalign.kernel_svr import KernelSvrBlockade
+from nanoalign.online import OnlineBlockade
 
 
-def _train_svr(mat_files, C=1000, gamma=0.001, epsilon=0.01):
-    """
-    Trains SVR with the given parameters
-    """
-    peptides, signals = _get_peptides_signals(mat_files)
+MODEL_TYPES = {"svr": SvrBlockade, "ksvr": KernelSvrBlockade,
+               "rf": RandomForestBlockade, "online": OnlineBlockade}
+PARAM_GRIDS = {"svr": OrderedDict([("C", [1, 10, 100, 1000, 10000, 100000]),
+                                   ("gamma", [0.00001, 0.0001, 0.001, 0.01,
+                                              0.1, 1]),
+                                   ("epsilon", [0.01, 0.001, 0.0001,
+                                                0.00001])]),
+               "ksvr": OrderedDict([("gamma", [0.0001, 0.001, 0.01, 0.1, 1]),
+                                    ("n_components", [100, 300, 1000]),
+                                    ("alpha", [0.01, 1, 100])]),
+               "rf": OrderedDict([("n_estimators", [10, 30, 100]),
+                                  ("max_depth", [None, 10, 20]),
+                                  ("min_samples_leaf", [1, 5, 20])]),
+               "online": OrderedDict([("alpha", [0.01, 0.1, 1, 10, 100,
+                                                 1000])])}
 
-    model = SvrBlockade()
-    model.train(peptides, signals, C, gamma, epsilon)
-    return model
+#set before the worker pool is forked, so the workers share
+#the preprocessed training signals and CV clusters
+_model_type = None
+_train_data = None
+_cv_data = None
 
 
-def _get_peptides_signals(mat_files):
+def _get_peptides_signals(mat_files, cache=None):
     TRAIN_AVG = 1
 
     peptides = []
     signals = []
     for mat in mat_files:
-        blockades = read_mat(mat)
-        clusters = sp.preprocess_blockades(blockades, cluster_size=TRAIN_AVG,
-                                           min_dwell=0.5, max_dwell=20)
-        mat_peptide = clusters[0].blockades[0].peptide
-        peptides.extend([mat_peptide] * len(clusters))
-
-        for cluster in clusters:
-            signals.append(sp.discretize(cluster.consensus, len(mat_peptide)))
+        mat_signals = preprocessed_signals(mat, cluster_size=TRAIN_AVG,
+                                           min_dwell=0.5, max_dwell=20,
+                                           cache=cache)
+        peptides.extend([mat_signals.peptide] * len(mat_signals.discrete))
+        signals.extend(mat_signals.discrete.tolist())
 
     return peptides, signals
 
 
-def _cross_validate(train_mats, cv_mats, db_file, out_file):
+def _get_cv_data(cv_mats, db_file, seed, cache=None):
     """
-    Choosing the best parameters through cross-validation
+    Preprocesses CV files once: returns (database, target id,
+    consensus clusters) for each file. Without a database file,
+    a random database is generated for each CV file
     """
     CLUSTER_SIZE = 10
+    RANDOM_DB_SIZE = 10000
+
+    cv_data = []
+    for cv_mat in cv_mats:
+        cv_signals = preprocessed_signals(cv_mat, cluster_size=CLUSTER_SIZE,
+                                          min_dwell=0.5, max_dwell=20,
+                                          seed=seed, cache=cache)
+        peptide = cv_signals.peptide
+        if db_file is None:
+            identifier = Identifier(None)
+            identifier.random_database(peptide, RANDOM_DB_SIZE)
+            database, target_id = identifier.database, "target"
+        else:
+            database, target_id = _make_database(db_file, peptide)
+        cv_data.append((database, target_id, cv_signals.clusters()))
+    return cv_data
+
+
+def _param_grid(model_type):
+    names, values = zip(*PARAM_GRIDS[model_type].items())
+    return map(lambda v: dict(zip(names, v)), product(*values))
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def _score_params(task):
+    """
+    Trains the model with the given parameters on the given training
+    signals and returns the mean (over CV files) of the median target
+    rank among the first num_clusters clusters of each CV file
+    """
+    params, train_indices, num_clusters = task
+    peptides, signals = _train_data
+    model = MODEL_TYPES[_model_type]()
+    model.train(map(peptides.__getitem__, train_indices),
+                map(signals.__getitem__, train_indices), **params)
+
+    scores = []
+    for database, target_id, clusters in _cv_data:
+        identifier = Identifier(model)
+        identifier.set_database(database)
+        ranks = map(lambda i: i[2]["target_rank"] - 1,
+                    identify_clusters(identifier, clusters[:num_clusters],
+                                      target_id))
+        scores.append(int(np.median(ranks)))
+    return params, np.mean(scores)
+
+
+def _inputs_digest(train_mats, cv_mats, db_file, seed):
+    """
+    Digest of everything the scores depend on besides the parameters
+    and budget: training and CV files content, CV database and the seed
+    """
+    inputs = {"train": map(file_sha1, train_mats),
+              "cv": map(file_sha1, cv_mats),
+              "database": db_file and [os.path.abspath(db_file),
+                                       file_sha1(db_file)],
+              "seed": seed}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _read_checkpoint(checkpoint_file, inputs):
+    """
+    Reads scores of the already evaluated (parameters, budget) pairs.
+    Records of other inputs or seed (see _inputs_digest) are skipped
+    """
+    scores = {}
+    skipped = 0
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("inputs") != inputs:
+                    skipped += 1
+                    continue
+                scores[(record["model"], _params_key(record["params"]),
+                        record["train_size"],
+                        record["cv_clusters"])] = record["score"]
+    if skipped:
+        print("Skipped {0} checkpoint records of other inputs or seed"
+              .format(skipped), file=sys.stderr)
+    return scores
+
+
+def _is_tsv_checkpoint(checkpoint_file):
+    """
+    Checks if the checkpoint was written by the previous version
+    (tab-separated C, gamma, epsilon and score of SVR)
+    """
+    if not os.path.exists(checkpoint_file):
+        return False
+    with open(checkpoint_file) as f:
+        for line in f:
+            if line.strip():
+                return not line.lstrip().startswith("{")
+    return False
+
+
+def _rung_budgets(num_train, num_clusters, halving, eta, min_budget):
+    """
+    Training set sizes and CV clusters per file for each rung. Each rung
+    has eta times smaller budget than the next one, the last rung has
+    the full budget and the first one at least min_budget
+    """
+    fractions = [1.0]
+    if halving:
+        while fractions[0] / eta >= min_budget * (1 - 1e-9):
+            fractions.insert(0, fractions[0] / eta)
+    return map(lambda f: (max(1, int(np.ceil(f * num_train))),
+                          max(1, int(np.ceil(f * num_clusters)))), fractions)
+
+
+def _cross_validate(model_type, train_mats, cv_mats, db_file, out_file,
+                    num_proc, checkpoint_file, halving=False, eta=3,
+                    min_budget=1.0 / 9, seed=1, cache=None):
+    """
+    Choosing the best parameters through cross-validation. Parameters
+    are evaluated in parallel, and each result is appended
+    to the checkpoint file, so an interrupted search could be resumed.
+    With successive halving, all candidates are first evaluated with
+    a small training subsample and a few CV clusters, and only the best
+    1/eta of them are promoted to the next rung with eta times
+    larger budget
+    """
+    global _model_type, _train_data, _cv_data
+
+    random.seed(seed)
+    _model_type = model_type
+    _train_data = _get_peptides_signals(train_mats, cache)
+    _cv_data = _get_cv_data(cv_mats, db_file, seed, cache)
+    train_order = np.random.RandomState(seed).permutation(len(_train_data[0]))
+    num_clusters = max(map(lambda d: len(d[2]), _cv_data))
+    budgets = _rung_budgets(len(train_order), num_clusters, halving, eta,
+                            min_budget)
+
+    inputs = _inputs_digest(train_mats, cv_mats, db_file, seed)
+    scores = _read_checkpoint(checkpoint_file, inputs)
+    #budget spent in this run and the number of rungs
+    #taken from the checkpoint
+    spent = OrderedDict((_params_key(p), [0, 0, 0])
+                        for p in _param_grid(model_type))
+    candidates = _param_grid(model_type)
+    checkpoint = open(checkpoint_file, "a") if checkpoint_file else None
+    pool = multiprocessing.Pool(num_proc)
+    try:
+        for rung, (train_size, cv_clusters) in enumerate(budgets):
+            print("\nRung {0}: {1} candidates, {2} training signals, "
+                  "{3} CV clusters per file".format(rung + 1, len(candidates),
+                                                    train_size, cv_clusters),
+                  file=sys.stderr)
+            train_indices = sorted(train_order[:train_size])
+
+            rung_scores = {}
+            remaining = []
+            for params in candidates:
+                key = (model_type, _params_key(params), train_size, cv_clusters)
+                if key in scores:
+                    rung_scores[_params_key(params)] = scores[key]
+                    spent[_params_key(params)][2] += 1
+                    print(_params_key(params), scores[key], "(checkpoint)",
+                          sep="\t", file=sys.stderr)
+                else:
+                    remaining.append((params, train_indices, cv_clusters))
+
+            for params, score in pool.imap_unordered(_score_params, remaining):
+                rung_scores[_params_key(params)] = score
+                spent[_params_key(params)][0] += train_size
+                spent[_params_key(params)][1] += cv_clusters * len(_cv_data)
+                print(_params_key(params), score, sep="\t", file=sys.stderr)
+                if checkpoint:
+                    checkpoint.write(json.dumps({"model": model_type,
+                                                 "params": params,
+                                                 "train_size": train_size,
+                                                 "cv_clusters": cv_clusters,
+                                                 "inputs": inputs,
+                                                 "score": score}) + "\n")
+                    checkpoint.flush()
+
+            #stable sort keeps the grid order for equal scores
+            candidates.sort(key=lambda p: rung_scores[_params_key(p)])
+            if rung < len(budgets) - 1:
+                candidates = candidates[:max(1, len(candidates) / eta)]
+        pool.close()
+    finally:
+        pool.terminate()
+        if checkpoint:
+            checkpoint.close()
+        _cv_data = None
+
+    print("\nParams\tTrain_signals\tCV_clusters\tCheckpoint_rungs",
+          file=sys.stderr)
+    for params, (train_spent, cv_spent, reused) in spent.items():
+        print(params, train_spent, cv_spent, reused, sep="\t",
+              file=sys.stderr)
 
-    eps_vec = [0.01, 0.001, 0.0001, 0.00001]
-    C_vec = [1, 10, 100, 1000, 10000, 100000]
-    gamma_vec = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1]
-
-    best_score = sys.maxint
-    best_params = None
-
-    print("C\tGam\tEps\tScore", file=sys.stderr)
-    for C in C_vec:
-        for gamma in gamma_vec:
-            for eps in eps_vec:
-                temp_model = _train_svr(train_mats, C, gamma, eps)
-
-                scores = []
-                for cv_mat in cv_mats:
-                    pval, rank = pvalues_test(cv_mat, CLUSTER_SIZE, temp_model,
-                                              db_file, False,
-                                              open(os.devnull, "w"))
-                    scores.append(rank)
-                score = np.mean(scores)
-
-                print("{0}\t{1}\t{2}\t{3}".format(C, gamma, eps, score),
-                      file=sys.stderr)
-                if score < best_score:
-                    best_score = score
-                    best_params = (C, gamma, eps)
-
-    print(*best_params, file=sys.stderr)
-    best_model = _train_svr(train_mats, *best_params)
+    best_params = candidates[0]
+    print("\nBest:", _params_key(best_params), file=sys.stderr)
+    best_model = MODEL_TYPES[model_type]()
+    best_model.train(*_train_data, **best_params)
     store_model(best_model, out_file)
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Nano-Align SVR model "
+    parser = argparse.ArgumentParser(description="Nano-Align model "
                                      "cross-validation", formatter_class= \
                                      argparse.ArgumentDefaultsHelpFormatter)
 
@@ -101,7 +292,7 @@ def main():
                         help="comma-separated list of files with train "
                         "blockades (in mat format)")
     parser.add_argument("out_file", metavar="out_file",
-                        help="path to the output SVR file "
+                        help="path to the output model file "
                         "(in Python's pickle format)")
     parser.add_argument("cv_blockades", metavar="cv_blockades",
                         help="comma-separated "
@@ -111,12 +302,49 @@ def main():
                         "(in FASTA format). If not set, random database "
                         "is generated",
                         default=None)
+    parser.add_argument("--model-type", dest="model_type",
+                        choices=sorted(MODEL_TYPES), default="svr",
+                        help="model type")
+    parser.add_argument("-t", "--threads", dest="threads", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of parallel processes")
+    parser.add_argument("--checkpoint", dest="checkpoint",
+                        metavar="checkpoint_file", default=None,
+                        help="file with the evaluated parameters, "
+                        "used to resume an interrupted search "
+                        "(default: out_file.cv)")
+    parser.add_argument("--halving", action="store_true", default=False,
+                        dest="halving", help="successive halving: promote "
+                        "only the best candidates to larger budgets")
+    parser.add_argument("--eta", dest="eta", type=int, default=3,
+                        help="budget growth and candidates reduction factor "
+                        "between the halving rungs")
+    parser.add_argument("--min-budget", dest="min_budget", type=float,
+                        default=1.0 / 9, help="minimum fraction of the "
+                        "training signals and CV clusters at the first "
+                        "halving rung")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="random seed for clustering and subsampling")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="directory for caching the preprocessed "
+                        "nanospectra")
+    parser.add_argument("--cache-size", dest="cache_size", type=int,
+                        default=1024, help="maximum cache size (MB)")
 
     parser.add_argument("--version", action="version", version=__version__)
     args = parser.parse_args()
-    _cross_validate(args.train_blockades.split(","),
+    checkpoint_file = args.checkpoint or args.out_file + ".cv"
+    if _is_tsv_checkpoint(checkpoint_file):
+        parser.error("{0} is a tab-separated checkpoint of the previous "
+                     "version. Its scores were computed on unseeded CV "
+                     "clusters and are not comparable, remove it or "
+                     "choose another --checkpoint".format(checkpoint_file))
+    cache = (SignalCache(args.cache_dir, args.cache_size << 20)
+             if args.cache_dir else None)
+    _cross_validate(args.model_type, args.train_blockades.split(","),
                     args.cv_blockades.split(","), args.cv_database,
-                    args.out_file)
+                    args.out_file, args.threads, checkpoint_file,
+                    args.halving, args.eta, args.min_budget, args.seed, cache)
     return 0
 
 
@@ -31,16 +31,17 @@ def flip(blockades, model_file):
     clusters = sp.preprocess_blockades(blockades, cluster_size=1,
                                        min_dwell=0.0, max_dwell=1000)
 
+    discr_signals = map(lambda c: sp.discretize(c.consensus, len(peptide)),
+                        clusters)
+    distances = identifier.signals_peptides_distances(discr_signals,
+                                                      [peptide, peptide[::-1]])
+
     print("Num\tFwd_dst\tRev_dst\t\tNeeds_flip", file=sys.stderr)
 
     num_reversed = 0
     new_blockades = []
     for num, cluster in enumerate(clusters):
-        discr_signal = sp.discretize(cluster.consensus, len(peptide))
-
-        fwd_dist = identifier.signal_protein_distance(discr_signal, peptide)
-        rev_dist = identifier.signal_protein_distance(discr_signal,
-                                                      peptide[::-1])
+        fwd_dist, rev_dist = distances[num]
         print("{0}\t{1:5.2f}\t{2:5.2f}\t\t{3}"
                 .format(num + 1, fwd_dist, rev_dist, fwd_dist > rev_dist),
                 file=sys.stderr)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2.7
+
+#(c) 2015-2016 by Authors
+#This file is a part of Nano-Align program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Generates synthetic nanospectra of a protein for load and scaling tests
+"""
+
+import sys
+import os
+import argparse
+
+nanoalign_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, nanoalign_root)
+from nanoalign.__version__ import __version__
+from nanoalign.synthetic import write_synthetic
+from nanoalign.model_loader import load_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic "
+                                     "nanospectra", formatter_class= \
+                                     argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("protein", metavar="protein",
+                        help="protein sequence")
+    parser.add_argument("num_nanospectra", metavar="num_nanospectra",
+                        type=int, help="number of nanospectra")
+    parser.add_argument("out_file", metavar="out_file",
+                        help="path to the output file (in mat format, or "
+                        "native format if ends with .npy)")
+    parser.add_argument("-m", "--model", dest="model_file", default="-",
+                        help="path to trained model file ('-' for MV model)")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="random seed")
+    parser.add_argument("--trace-len", dest="trace_len", type=int,
+                        default=10000, help="samples per nanospectra")
+    parser.add_argument("--noise", dest="noise", type=float, default=0.05,
+                        help="noise deviation (fraction of open pore)")
+    parser.add_argument("--speed-var", dest="speed_var", type=float,
+                        default=0.3, help="translocation speed variation "
+                        "(log-normal sigma)")
+    parser.add_argument("--max-flank", dest="max_flank", type=float,
+                        default=0.05, help="maximum flank length "
+                        "(fraction of trace)")
+    parser.add_argument("--open-pore", dest="open_pore", type=float,
+                        default=-100.0, help="mean open pore current")
+    parser.add_argument("--dwell", dest="dwell_median", type=float,
+                        default=3.0, help="median dwell time (ms)")
+    parser.add_argument("--version", action="version", version=__version__)
+    args = parser.parse_args()
+
+    write_synthetic(args.out_file, args.protein, args.num_nanospectra,
+                    blockade_model=load_model(args.model_file),
+                    seed=args.seed, trace_len=args.trace_len,
+                    noise=args.noise, speed_var=args.speed_var,
+                    max_flank=args.max_flank, open_pore=args.open_pore,
+                    dwell_median=args.dwell_median)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,52 +12,89 @@ from __future__ import print_function
 import sys
 import os
 import argparse
+import multiprocessing
 
 import numpy as np
 
 from nanoalign.__version__ import __version__
-import nanoalign.signal_proc as sp
-from nanoalign.blockade import read_mat
-from nanoalign.pvalues_test import pvalues_test
-from nanoalign.model_loader import store_model
+from nanoalign.cache import SignalCache, preprocessed_signals
+from nanoalign.model_loader import load_model, store_model
 from nanoalign.svr import SvrBlockade
 from nanoalign.random_forest import RandomForestBlockade
+from nanoalign.online import OnlineBlockade
+from nanoalign.kernel_svr import KernelSvrBlockade, KERNEL_APPROXIMATIONS
+from nanoalign.profiling import run_profiled
 
 
-def _train_random_forest(mat_files, out_file):
+def _train_random_forest(mat_files, out_file, n_estimators=10, n_jobs=1,
+                         update_file=None, cache=None):
     """
-    Trains Random Forest
+    Trains Random Forest. If update_file is given, the trees of
+    that model are kept and n_estimators more are grown on the new files
     """
-    peptides, signals = _get_peptides_signals(mat_files)
-    model = RandomForestBlockade()
-    model.train(peptides, signals)
+    peptides, signals = _get_peptides_signals(mat_files, cache)
+    if update_file is not None:
+        model = load_model(update_file)
+        if not isinstance(model, RandomForestBlockade):
+            raise ValueError("Only RandomForest models could be updated")
+        model.update(peptides, signals, n_estimators, n_jobs)
+    else:
+        model = RandomForestBlockade()
+        model.train(peptides, signals, n_estimators, n_jobs=n_jobs)
     store_model(model, out_file)
 
 
-def _train_svr(mat_files, out_file, C=1000, gamma=0.001, epsilon=0.01):
+def _train_svr(mat_files, out_file, C=1000, gamma=0.001, epsilon=0.01,
+               cache=None):
     """
     Trains SVR with the given parameters
     """
-    peptides, signals = _get_peptides_signals(mat_files)
+    peptides, signals = _get_peptides_signals(mat_files, cache)
     model = SvrBlockade()
     model.train(peptides, signals, C, gamma, epsilon)
     store_model(model, out_file)
 
 
-def _get_peptides_signals(mat_files):
+def _train_kernel_svr(mat_files, out_file, approximation, n_components,
+                      cache=None):
+    """
+    Trains SVR with an approximate kernel
+    """
+    peptides, signals = _get_peptides_signals(mat_files, cache)
+    model = KernelSvrBlockade()
+    model.train(peptides, signals, n_components=n_components,
+                approximation=approximation)
+    store_model(model, out_file)
+
+
+def _train_online(mat_files, out_file, update_file=None, cache=None):
+    """
+    Trains the online model. If update_file is given, that model is
+    refined with the new files only
+    """
+    peptides, signals = _get_peptides_signals(mat_files, cache)
+    if update_file is not None:
+        model = load_model(update_file)
+        if not isinstance(model, OnlineBlockade):
+            raise ValueError("Only Online models could be refined")
+        model.partial_fit(peptides, signals)
+    else:
+        model = OnlineBlockade()
+        model.train(peptides, signals)
+    store_model(model, out_file)
+
+
+def _get_peptides_signals(mat_files, cache=None):
     TRAIN_AVG = 1
 
     peptides = []
     signals = []
     for mat in mat_files:
-        blockades = read_mat(mat)
-        clusters = sp.preprocess_blockades(blockades, cluster_size=TRAIN_AVG,
-                                           min_dwell=0.5, max_dwell=20)
-        mat_peptide = clusters[0].blockades[0].peptide
-        peptides.extend([mat_peptide] * len(clusters))
-
-        for cluster in clusters:
-            signals.append(sp.discretize(cluster.consensus, len(mat_peptide)))
+        mat_signals = preprocessed_signals(mat, cluster_size=TRAIN_AVG,
+                                           min_dwell=0.5, max_dwell=20,
+                                           cache=cache)
+        peptides.extend([mat_signals.peptide] * len(mat_signals.discrete))
+        signals.extend(mat_signals.discrete.tolist())
 
     return peptides, signals
 
@@ -68,21 +105,68 @@ def main():
                                      argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("model_type", metavar="model_type",
-                        choices=["svr", "rf"],
-                        help="model type ('svr' or 'rf')")
+                        choices=["svr", "ksvr", "rf", "online"],
+                        help="model type ('svr', 'ksvr' for SVR with "
+                        "approximate kernel, which is faster on large "
+                        "training sets, 'rf' or 'online', which could be "
+                        "refined with new nanospectra)")
     parser.add_argument("training_nanospectra", metavar="training_nanospectra",
                         help="comma-separated list of files with training "
                         "nanospectra (in mat format)")
     parser.add_argument("out_file", metavar="out_file",
                         help="path to the output file "
                         "(in Python's pickle format)")
+    parser.add_argument("--kernel-approximation", dest="approximation",
+                        choices=KERNEL_APPROXIMATIONS, default="nystroem",
+                        help="kernel approximation for 'ksvr'")
+    parser.add_argument("--components", dest="components", type=int,
+                        default=300, help="dimension of the approximate "
+                        "kernel features for 'ksvr'")
+    parser.add_argument("--trees", dest="trees", type=int, default=10,
+                        help="number of trees for 'rf' (added to the existing "
+                        "ones with --update)")
+    parser.add_argument("--update", dest="update", metavar="model_file",
+                        default=None, help="refine the given 'rf' (grow "
+                        "more trees) or 'online' model with the new training "
+                        "nanospectra")
+    parser.add_argument("-t", "--threads", dest="threads", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of parallel jobs for building the trees")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="directory for caching the preprocessed "
+                        "nanospectra")
+    parser.add_argument("--cache-size", dest="cache_size", type=int,
+                        default=1024, help="maximum cache size (MB)")
+    parser.add_argument("--profile", dest="profile", metavar="report_file",
+                        default=None, help="write per-stage timings "
+                        "(JSON if ends with .json, TSV otherwise)")
+    parser.add_argument("--cprofile", dest="cprofile", metavar="stats_file",
+                        default=None, help="run under cProfile and dump "
+                        "the stats file")
     parser.add_argument("--version", action="version", version=__version__)
     args = parser.parse_args()
-
-    if args.model_type == "svr":
-        _train_svr(args.training_nanospectra.split(","), args.out_file)
-    else:
-        _train_random_forest(args.training_nanospectra.split(","), args.out_file)
+    if args.update and args.model_type not in ["rf", "online"]:
+        parser.error("--update is supported only for 'rf' and 'online' "
+                     "models")
+
+    cache = (SignalCache(args.cache_dir, args.cache_size << 20)
+             if args.cache_dir else None)
+    def train():
+        if args.model_type == "svr":
+            _train_svr(args.training_nanospectra.split(","), args.out_file,
+                       cache=cache)
+        elif args.model_type == "ksvr":
+            _train_kernel_svr(args.training_nanospectra.split(","),
+                              args.out_file, args.approximation,
+                              args.components, cache)
+        elif args.model_type == "online":
+            _train_online(args.training_nanospectra.split(","),
+                          args.out_file, args.update, cache)
+        else:
+            _train_random_forest(args.training_nanospectra.split(","),
+                                 args.out_file, args.trees, args.threads,
+                                 args.update, cache)
+    run_profiled(train, args.profile, args.cprofile)
     return 0
 
 